@@ -1,16 +1,64 @@
 import streamlit as st
-import yfinance as yf
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import gspread
-from google.oauth2.service_account import Credentials
-from datetime import date
+import numpy as np
+from datetime import date, datetime, time as dtime, timedelta
+from zoneinfo import ZoneInfo
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 from streamlit import runtime
 import os
+import re
+import bisect
 import sys
 import json
+import codecs
+import sqlite3
 import time
+import threading
+import random
+import hashlib
+import hmac
+import secrets
+import functools
+import importlib
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from nexus_errors import RateLimited, CircuitOpen, StorageNotFound  # 獨立模組：跨 rerun 保持同一個類別
+
+class LazyModule:
+    # 第一次取用屬性時才 import；yfinance、plotly、gspread 載入要數百 ms，登入頁用不到
+    def __init__(self, name):
+        self._name, self._module, self._hooks = name, None, []
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is not None: return self._module
+        with self._lock:
+            if self._module is None:
+                # 每次 rerun 都會重新執行本檔、建立新的 proxy；只有 process 內第一次真的載入才記錄耗時
+                loaded, started = self._name in sys.modules, time.perf_counter()
+                module = importlib.import_module(self._name)
+                if not loaded: get_perf_metrics().record(f"import.{self._name}", time.perf_counter() - started)
+                for hook in self._hooks: hook(module)
+                self._module, self._hooks = module, []
+        return self._module
+
+    def on_load(self, hook):
+        # 模組載入後執行 hook(module)；已經載入就立即執行
+        with self._lock:
+            if self._module is None:
+                self._hooks.append(hook)
+                return
+        hook(self._module)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+yf = LazyModule("yfinance")
+px = LazyModule("plotly.express")
+go = LazyModule("plotly.graph_objects")
+gspread = LazyModule("gspread")
 
 # --- 1. 系統設定 ---
 st.set_page_config(page_title="NEXUS: Wealth Command", layout="wide", page_icon="🌌")
@@ -56,10 +104,299 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
+# --- 效能量測 ---
+PERF_HISTORY = 50                      # 保留最近幾次 rerun 的明細
+METRICS_MAX_BYTES = 5 * 1024 * 1024    # 指標檔超過此大小時輪替成 .1
+
+class PerfMetrics:
+    # 外部呼叫與 main_app 各階段的次數與耗時
+    # totals：process 啟動以來的累計；rerun 明細只計 script 執行緒 (背景同步、報價更新只進累計)
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rolling = {}   # 名稱 -> [次數, 秒數]
+        self.recent = deque(maxlen=PERF_HISTORY)
+        self.reruns = 0
+        self.local = threading.local()
+
+    def record(self, name, seconds):
+        with self.lock:
+            entry = self.rolling.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        bucket = getattr(self.local, "bucket", None)
+        if bucket is not None:
+            entry = bucket.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    @contextmanager
+    def rerun(self, session, scope="app"):
+        # 包住整次 rerun 或單獨重跑的 fragment；結束時 (含 st.rerun / st.stop) 把明細存進 session 並寫入指標檔
+        # 整頁 rerun 裡執行的 fragment 已經在外層的明細內，直接併入
+        if getattr(self.local, "bucket", None) is not None:
+            yield
+            return
+        self.local.bucket = {}
+        started = time.perf_counter()
+        try: yield
+        finally:
+            bucket, self.local.bucket = self.local.bucket, None
+            entry = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "user": session.get("current_user"), "scope": scope,
+                     "seconds": round(time.perf_counter() - started, 6),
+                     "calls": {k: {"count": c, "seconds": round(s, 6)} for k, (c, s) in bucket.items()}}
+            with self.lock:
+                self.reruns += 1
+                self.recent.append(entry)
+            session["perf_last"] = entry
+            self._write(entry)
+
+    def totals(self):
+        with self.lock: return {k: {"count": c, "seconds": s} for k, (c, s) in self.rolling.items()}
+
+    def _write(self, entry):
+        # 每次 rerun 一行 JSON，供監控程式讀取
+        if not self.path: return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > METRICS_MAX_BYTES: os.replace(self.path, f"{self.path}.1")
+            with open(self.path, "a", encoding="utf-8") as fp: fp.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError: pass
+
+@st.cache_resource
+def get_perf_metrics():
+    # NEXUS_METRICS_FILE 設為空字串可關閉指標檔
+    return PerfMetrics(os.environ.get("NEXUS_METRICS_FILE", os.path.join(CACHE_DIR, "metrics.jsonl")))
+
+@contextmanager
+def timed(name):
+    started = time.perf_counter()
+    try: yield
+    finally: get_perf_metrics().record(name, time.perf_counter() - started)
+
+def metered(scope):
+    # fragment 單獨 rerun 時不會經過 __main__ 的 rerun 區塊；裝在 fragment 上，讓它自己記一筆 rerun 明細
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_perf_metrics().rerun(st.session_state, scope): return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_call(fn, name, metrics):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try: return fn(*args, **kwargs)
+        finally: metrics.record(name, time.perf_counter() - started)
+    wrapper._perf_wrapped = True
+    return wrapper
+
+def instrument_external_calls(metrics):
+    # 包裝 gspread 與 yfinance 的外部呼叫；類別與模組在 process 內共用，已包過的不再重包
+    # 兩者都是延遲載入，等第一次被用到、真的 import 之後才包裝
+    if isinstance(gspread, LazyModule):
+        gspread.on_load(lambda m: wrap_external_calls(metrics, [
+            (m.Client, ["open", "open_by_key"], "sheets"),
+            (m.Spreadsheet, ["worksheets", "worksheet", "add_worksheet", "values_batch_get", "values_batch_update", "values_batch_clear"], "sheets"),
+            (m.Worksheet, ["get_all_records", "get_all_values", "col_values", "update", "clear", "append_row"], "sheets"),
+        ]))
+    if isinstance(yf, LazyModule):
+        yf.on_load(lambda m: wrap_external_calls(metrics, [(m.Ticker, ["history", "info"], "yf"), (m, ["download"], "yf")]))
+
+def wrap_external_calls(metrics, targets):
+    for owner, attrs, prefix in targets:
+        for attr in attrs:
+            raw = next((vars(k)[attr] for k in getattr(owner, "__mro__", [owner]) if attr in vars(k)), None)
+            if raw is None or getattr(getattr(raw, "fget", raw), "_perf_wrapped", False): continue
+            if isinstance(raw, property): setattr(owner, attr, property(timed_call(raw.fget, f"{prefix}.{attr}", metrics)))
+            else: setattr(owner, attr, timed_call(raw, f"{prefix}.{attr}", metrics))
+
+def perf_frame(calls):
+    df = pd.DataFrame([{"項目": k, "次數": v["count"], "總耗時 (ms)": v["seconds"] * 1000, "平均 (ms)": v["seconds"] * 1000 / max(v["count"], 1)}
+                       for k, v in calls.items()], columns=["項目", "次數", "總耗時 (ms)", "平均 (ms)"])
+    return df.sort_values("總耗時 (ms)", ascending=False)
+
+def perf_panel():
+    # 側邊欄診斷：上一次 rerun 的明細與 process 累計
+    metrics = get_perf_metrics()
+    fmt = {"總耗時 (ms)": st.column_config.NumberColumn(format="%.1f"), "平均 (ms)": st.column_config.NumberColumn(format="%.1f")}
+    last = st.session_state.get("perf_last")
+    if last:
+        st.caption(f"上一次 rerun ({last.get('scope', 'app')})：{last['seconds'] * 1000:,.0f} ms")
+        st.dataframe(perf_frame(last["calls"]), hide_index=True, column_config=fmt)
+    st.caption(f"累計 ({metrics.reruns} 次 rerun)")
+    st.dataframe(perf_frame(metrics.totals()), hide_index=True, column_config=fmt)
+    if metrics.path: st.caption(f"指標檔：{metrics.path}")
+    st.caption("外部 API 排程")
+    st.dataframe(pd.DataFrame([s.stats() for s in get_schedulers().values()]), hide_index=True)
+
+# --- 外部 API 排程：配額 (token bucket)、重試與斷路器 ---
+API_LIMITS = {  # 後端 -> 每分鐘請求數與可瞬間用掉的額度；Sheets 配額以服務帳號計，所有使用者共用
+    "sheets": {"per_minute": float(os.environ.get("NEXUS_SHEETS_RPM", 60)), "burst": 10},
+    "yf": {"per_minute": float(os.environ.get("NEXUS_YF_RPM", 600)), "burst": 100},
+}
+API_MAX_RETRIES = 4         # 暫時性錯誤 (429、5xx、連線錯誤) 的重試次數
+API_BACKOFF_BASE = 1.0      # 指數退避的起始秒數，實際等待再乘上 0.5~1 的隨機抖動
+API_BACKOFF_MAX = 30.0
+BREAKER_THRESHOLD = 5       # 連續幾次暫時性錯誤後斷路
+BREAKER_COOLDOWN = 30.0     # 斷路後多久放行一個試探請求；試探失敗時冷卻加倍，最多 BREAKER_COOLDOWN_MAX
+BREAKER_COOLDOWN_MAX = 300.0
+
+def is_transient(e):
+    # 429、5xx、連線錯誤與限流可以重試；找不到檔案、權限不足、資料錯誤等直接拋出
+    if isinstance(e, (RateLimited, TimeoutError, ConnectionError)): return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if isinstance(status, int): return status == 429 or status >= 500
+    return "RateLimit" in type(e).__name__ or isinstance(e, OSError)
+
+def retry_after(e):
+    # 429 回應的 Retry-After 標頭 (秒)；沒有則回傳 None
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try: return min(API_BACKOFF_MAX, float(headers.get("Retry-After")))
+    except (TypeError, ValueError): return None
+
+class TokenBucket:
+    # 每秒補充 per_minute / 60 個 token，最多累積 burst 個；額度不足時先預扣 (可為負) 再等待，先到先服務
+    def __init__(self, per_minute, burst):
+        self.rate, self.capacity = per_minute / 60.0, float(max(1, burst))
+        self.tokens, self.stamp = self.capacity, time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        # 回傳等待的秒數；cost 超過容量時以容量計，大批次不會永遠等不到
+        cost = min(float(cost), self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= cost
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait: time.sleep(wait)
+        return wait
+
+class RequestScheduler:
+    # 一個外部後端一個排程器 (process 內共用)：token bucket 控制每分鐘請求數，暫時性錯誤以指數退避加抖動重試，
+    # 連續失敗達門檻時斷路，冷卻期間的呼叫立即以 CircuitOpen 失敗，不會讓每次 rerun 都卡在逾時上
+    def __init__(self, name, per_minute, burst, retries=API_MAX_RETRIES):
+        self.name, self.retries = name, retries
+        self.bucket = TokenBucket(per_minute, burst)
+        self.lock = threading.Lock()
+        self.failures, self.open_until, self.cooldown, self.probing = 0, 0.0, BREAKER_COOLDOWN, False
+        self.counts = {"calls": 0, "retries": 0, "errors": 0, "rejected": 0, "throttled_s": 0.0}
+
+    def state(self):
+        with self.lock:
+            if self.failures < BREAKER_THRESHOLD: return "closed"
+            return "open" if time.time() < self.open_until else "half-open"
+
+    def _admit(self):
+        with self.lock:
+            if self.failures < BREAKER_THRESHOLD: return
+            if time.time() < self.open_until or self.probing:
+                self.counts["rejected"] += 1
+                raise CircuitOpen(self.name, max(self.open_until, time.time() + 1))
+            self.probing = True  # 冷卻結束：只放行一個試探請求
+
+    def _settle(self, ok):
+        with self.lock:
+            probe, self.probing = self.probing, False
+            if ok:
+                self.failures, self.cooldown = 0, BREAKER_COOLDOWN
+                return
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                if probe: self.cooldown = min(BREAKER_COOLDOWN_MAX, self.cooldown * 2)
+                self.open_until = time.time() + self.cooldown
+
+    def call(self, fn, *args, cost=1, **kwargs):
+        # cost：這次呼叫實際送出的請求數 (例如 yf.download 每檔一次)
+        attempt = 0
+        while True:
+            self._admit()
+            waited = self.bucket.acquire(cost)
+            with self.lock:
+                self.counts["calls"] += 1
+                self.counts["throttled_s"] += waited
+            if waited: get_perf_metrics().record(f"{self.name}.throttled", waited)
+            try: result = fn(*args, **kwargs)
+            except Exception as e:
+                transient = is_transient(e)
+                self._settle(not transient)  # 非暫時性錯誤代表後端有回應，不計入斷路
+                if not transient or attempt >= self.retries:
+                    with self.lock: self.counts["errors"] += 1
+                    raise
+                delay = retry_after(e) or min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                with self.lock: self.counts["retries"] += 1
+                get_perf_metrics().record(f"{self.name}.retry", delay)
+                time.sleep(delay)
+                continue
+            self._settle(True)
+            return result
+
+    def stats(self):
+        state = self.state()
+        with self.lock:
+            c = self.counts
+            return {"後端": self.name, "狀態": state, "剩餘額度": round(max(0.0, self.bucket.tokens), 1), "呼叫": c["calls"],
+                    "重試": c["retries"], "失敗": c["errors"], "斷路拒絕": c["rejected"], "限流等待 (s)": round(c["throttled_s"], 2)}
+
+@st.cache_resource
+def get_schedulers():
+    return {name: RequestScheduler(name, **limits) for name, limits in API_LIMITS.items()}
+
+def api_call(backend, fn, *args, cost=1, **kwargs):
+    return get_schedulers()[backend].call(fn, *args, cost=cost, **kwargs)
+
+class YfRateLimitProbe(logging.Handler):
+    # yf.download 把每檔的錯誤寫進 log 而不丟出；計算其中的限流訊息，讓呼叫端能當成可重試的錯誤
+    nexus_rate_limit_probe = True
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.hits = 0
+
+    def emit(self, record):
+        msg = record.getMessage()
+        if "Too Many Requests" in msg or "RateLimit" in msg: self.hits += 1
+
+def yf_rate_limit_probe():
+    # 掛在 yfinance logger 上的計數器；本檔每次 rerun 都會重新執行，以屬性辨識已掛上的那一個
+    logger = logging.getLogger("yfinance")
+    probe = next((h for h in logger.handlers if getattr(h, "nexus_rate_limit_probe", False)), None)
+    if probe is None:
+        probe = YfRateLimitProbe()
+        logger.addHandler(probe)
+    return probe
+
+def yf_download(symbols, **kwargs):
+    # 經由排程器呼叫 yf.download，每檔算一次請求；期間出現限流訊息時整批視為可重試的錯誤
+    # (同時進行的其他下載若被限流也會被算進來，最多只是多重試一次)
+    probe = yf_rate_limit_probe()
+    def attempt():
+        before = probe.hits
+        data = yf.download(list(symbols), group_by="column", threads=True, progress=False, **kwargs)
+        if probe.hits > before: raise RateLimited(f"yfinance 限流 ({len(symbols)} 檔)")
+        return data
+    return api_call("yf", attempt, cost=len(symbols))
+
 # --- 2. 雲端資料庫核心 ---
 
 ADMIN_DB_NAME = "nexus_data"
-EXCHANGE_RATE = 32.5 
+EXCHANGE_RATE = 32.5  # 匯率表取不到 USD 時的備用值；其他幣別取不到時為 NaN，該列不計入總額
+
+# 個人試算表的工作表與標題列
+SHEET_SCHEMA = {
+    "US_Stocks": ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"],
+    "TW_Stocks": ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"],
+    "Fixed_Assets": ["資產項目", "現值", "類別"],
+    "Liabilities": ["負債項目", "金額", "每月扣款"],
+    "Settings": ["Key", "Value"],
+    "History": ["Date", "Net_Worth", "Total_Assets", "Total_Liabilities", "Monthly_Payment"]
+}
+# 工作表 -> session_state 的資料鍵
+SHEET_TABLES = {"US_Stocks": "us_data", "TW_Stocks": "tw_data", "Fixed_Assets": "fixed_data", "Liabilities": "liab_data"}
 
 @st.cache_resource(ttl=600)
 def get_google_client():
@@ -79,6 +416,7 @@ def get_google_client():
             if "\\n" in key: key = key.replace("\\n", "\n")
             creds_dict["private_key"] = key
 
+        from google.oauth2.service_account import Credentials  # 延遲載入，同 gspread
         creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
         return gspread.authorize(creds)
     except Exception as e:
@@ -91,75 +429,355 @@ def get_service_email():
     except:
         return "無法取得 Email"
 
+# --- 使用者目錄 ---
+USER_DIR_TTL = 300          # 使用者清單快取時間 (秒)，過期後於背景重新整理
+USER_DIR_MISS_REFRESH = 30  # 查無帳號時，最多每 30 秒重新讀取一次 Users
+PBKDF2_ITERATIONS = 200_000
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    # 產生可存入 Users 表 Password_Hash 欄的雜湊字串；密碼去除前後空白，與登入時的處理一致
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", str(password).strip().encode(), bytes.fromhex(salt), iterations).hex()
+    return f"pbkdf2_sha256${iterations}${salt}${digest}"
+
+def verify_password(password, stored):
+    try:
+        scheme, *parts = stored.split("$")
+        if scheme == "pbkdf2_sha256":
+            iterations, salt, digest = parts
+            return hmac.compare_digest(hash_password(password, salt, int(iterations)), stored)
+        if scheme == "sha256":
+            salt, digest = parts
+            return hmac.compare_digest(hashlib.sha256(bytes.fromhex(salt) + str(password).strip().encode()).hexdigest(), digest)
+    except ValueError: pass
+    return False
+
+class UserDirectory:
+    # Username -> {"hash", "target"}；只在記憶體保留雜湊，不保留明碼
+    def __init__(self, loader, ttl=USER_DIR_TTL):
+        self.loader, self.ttl = loader, ttl
+        self.users, self.loaded_at, self.missed_at = {}, 0.0, 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.salt = os.urandom(16)  # 舊版明碼欄位在載入時以此鹽值雜湊
+
+    def refresh(self):
+        users = {}
+        for rec in self.loader():
+            name = str(rec.get('Username', '')).strip()
+            if not name: continue
+            stored = str(rec.get('Password_Hash', '') or '').strip()
+            if not stored:
+                plain = str(rec.get('Password', '')).strip()
+                stored = f"sha256${self.salt.hex()}${hashlib.sha256(self.salt + plain.encode()).hexdigest()}"
+            users[name] = {"hash": stored, "target": str(rec.get('Target_Sheet'))}
+        with self.lock: self.users, self.loaded_at = users, time.time()
+
+    def _refresh_in_background(self):
+        with self.lock:
+            if self.refreshing: return
+            self.refreshing = True
+
+        def worker():
+            try: self.refresh()
+            except Exception: pass
+            finally:
+                with self.lock: self.refreshing = False
+        threading.Thread(target=worker, daemon=True).start()
+
+    def lookup(self, username):
+        username = str(username).strip()
+        if not self.loaded_at: self.refresh()
+        elif time.time() - self.loaded_at > self.ttl: self._refresh_in_background()
+        user = self.users.get(username)
+        if user is None and time.time() - self.missed_at > USER_DIR_MISS_REFRESH:
+            # 可能是剛新增的帳號：同步重讀一次
+            self.missed_at = time.time()
+            self.refresh()
+            user = self.users.get(username)
+        return user
+
+    def authenticate(self, username, password):
+        user = self.lookup(username)
+        if user and verify_password(str(password).strip(), user["hash"]): return user["target"]
+        return None
+
+@st.cache_resource
+def get_user_directory():
+    return UserDirectory(get_storage().load_users)
+
 def check_login(username, password):
     try:
-        client = get_google_client()
-        if not client: return None
-        sh = client.open(ADMIN_DB_NAME)
-        ws = sh.worksheet("Users")
-        users_data = ws.get_all_records()
-        for user in users_data:
-            if str(user.get('Username')).strip() == str(username).strip() and \
-               str(user.get('Password')).strip() == str(password).strip():
-                return str(user.get('Target_Sheet'))
+        return get_user_directory().authenticate(username, password)
+    except StorageNotFound:
+        st.error(f"❌ 找不到試算表 '{ADMIN_DB_NAME}'！")
+        st.info(f"請確認您已將該檔案分享給機器人：\n\n**{get_service_email()}**")
         return None
     except Exception as e:
-        if "SpreadsheetNotFound" in str(e):
-            st.error(f"❌ 找不到試算表 '{ADMIN_DB_NAME}'！")
-            st.info(f"請確認您已將該檔案分享給機器人：\n\n**{get_service_email()}**")
-        else:
-            st.error(f"登入錯誤: {e}")
+        st.error(f"登入錯誤: {e}")
         return None
 
-def init_user_sheet(target_sheet_name):
-    client = get_google_client()
-    if not client: return None
-    try:
-        sh = client.open(target_sheet_name)
-    except:
-        st.error(f"❌ 找不到個人試算表：{target_sheet_name}")
-        st.info(f"請去 Google Drive 確認檔案存在，並分享給：\n\n**{get_service_email()}**")
-        st.stop()
-    
-    required = {
-        "US_Stocks": ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"],
-        "TW_Stocks": ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"],
-        "Fixed_Assets": ["資產項目", "現值", "類別"],
-        "Liabilities": ["負債項目", "金額", "每月扣款"],
-        "Settings": ["Key", "Value"],
-        "History": ["Date", "Net_Worth", "Total_Assets", "Total_Liabilities", "Monthly_Payment"]
-    }
-    try:
-        curr_titles = [ws.title for ws in sh.worksheets()]
-        for title, headers in required.items():
-            if title not in curr_titles:
-                ws = sh.add_worksheet(title=title, rows=50, cols=10)
-                ws.append_row(headers)
-    except: pass
-    return sh
+SHEET_HANDLE_TTL = 600  # 試算表 / 工作表 handle 的快取時間 (秒)
+
+def parse_sheet_key(target_sheet_name):
+    # Target_Sheet 可以是試算表名稱、ID 或完整網址；網址與 44 字元的 ID 回傳 ID，其餘 (含很長的檔名) 都當名稱
+    target = str(target_sheet_name).strip()
+    m = re.search(r"/spreadsheets/d/([A-Za-z0-9_-]+)", target)
+    if m: return m.group(1)
+    if re.fullmatch(r"[A-Za-z0-9_-]{44}", target): return target
+    return None
+
+# --- 儲存後端 ---
+# app 與後端之間以工作表的二維陣列 (標題列 + 資料列，欄位依 SHEET_SCHEMA) 交換資料
+STORAGE_BACKEND = os.environ.get("NEXUS_STORAGE", "sheets")  # sheets / sqlite
+SQLITE_STORAGE_PATH = os.environ.get("NEXUS_SQLITE_PATH")     # 預設 .nexus_cache/nexus.db
+
+class StorageBackend(ABC):
+    # 使用者清單、四張資產表與設定、History 的讀寫介面；不碰 st.session_state，背景執行緒也能使用
+    # 介面方法都是抽象方法：新後端漏實作任何一個，建立實例時就會 TypeError，而不是等到執行期才出錯
+    name = "base"
+
+    @abstractmethod
+    def load_users(self):
+        # -> [{"Username", "Password_Hash" 或 "Password", "Target_Sheet"}]
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_tables(self, target):
+        # -> {"grids": {工作表: 二維陣列}, "history_dates": [YYYY-MM-DD], "requests": 送出的請求數}
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_tables(self, target, grids, synced):
+        # 只寫入和 synced (上次同步內容) 不同的部分，成功後更新 synced；回傳是否有寫入
+        raise NotImplementedError
+
+    @abstractmethod
+    def history_dates(self, target):
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_history(self, target, row):
+        # row：[Date, Net_Worth, Total_Assets, Total_Liabilities, Monthly_Payment]
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_history(self, target):
+        # -> History 二維陣列 (含標題列)
+        raise NotImplementedError
+
+class SheetsBackend(StorageBackend):
+    # Google Sheets：每位使用者一份試算表，Users 放在 ADMIN_DB_NAME
+    name = "sheets"
+
+    def __init__(self, client_factory):
+        self.client_factory = client_factory
+        self.handles = {}  # target -> {"sh", "worksheets", "ts"}
+        self.lock = threading.Lock()
+
+    def open(self, target, stats=None):
+        # 重用已開啟的試算表與工作表，TTL 內不再搜尋檔名或檢查結構；stats (可選) 累計送出的請求數
+        stats = stats if stats is not None else {}
+        stats.setdefault("requests", 0)
+        with self.lock: cached = self.handles.get(target)
+        if cached and time.time() - cached["ts"] < SHEET_HANDLE_TTL: return cached["sh"]
+
+        client = self.client_factory()
+        try:
+            key = parse_sheet_key(target)
+            try:
+                sh = api_call("sheets", client.open_by_key, key) if key else api_call("sheets", client.open, target)
+            except Exception as e:
+                # 看起來像 ID 的也可能只是檔名：不是網址且依 ID 找不到時，再依名稱找一次
+                if not key or key != target or is_transient(e) or isinstance(e, CircuitOpen): raise
+                stats["requests"] += 1
+                sh = api_call("sheets", client.open, target)
+            stats["requests"] += 1
+        except Exception as e:
+            if is_transient(e) or isinstance(e, CircuitOpen): raise  # 限流或斷線不是找不到檔案
+            raise StorageNotFound(target) from e
+
+        worksheets = {}
+        try:
+            worksheets = {ws.title: ws for ws in api_call("sheets", sh.worksheets)}
+            stats["requests"] += 1
+            for title, headers in SHEET_SCHEMA.items():
+                if title not in worksheets:
+                    ws = api_call("sheets", sh.add_worksheet, title=title, rows=50, cols=10)
+                    api_call("sheets", ws.append_row, headers)
+                    worksheets[title] = ws
+                    stats["requests"] += 2
+        except Exception as e:
+            if is_transient(e) or isinstance(e, CircuitOpen): raise  # 不快取不完整的工作表清單
+        with self.lock: self.handles[target] = {"sh": sh, "worksheets": worksheets, "ts": time.time()}
+        return sh
+
+    def worksheet(self, target, title):
+        sh = self.open(target)
+        with self.lock: ws = self.handles[target]["worksheets"].get(title)
+        return ws if ws is not None else api_call("sheets", sh.worksheet, title)
+
+    def load_users(self):
+        try: sh = api_call("sheets", self.client_factory().open, ADMIN_DB_NAME)
+        except gspread.SpreadsheetNotFound as e: raise StorageNotFound(ADMIN_DB_NAME) from e
+        return api_call("sheets", api_call("sheets", sh.worksheet, "Users").get_all_records)
+
+    def load_tables(self, target):
+        stats = {"requests": 0}
+        sh = self.open(target, stats)
+        # 五張表與 History 的日期欄用一次 values:batchGet 讀回
+        titles = list(SHEET_TABLES) + ["Settings"]
+        resp = api_call("sheets", sh.values_batch_get, [f"'{t}'" for t in titles] + ["'History'!A:A"],
+                        params={"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"})
+        stats["requests"] += 1
+        value_ranges = resp.get("valueRanges", [])
+        hist_dates = [norm_date(r[0]) for r in (value_ranges[-1].get("values", [])[1:] if len(value_ranges) > len(titles) else []) if r]
+        grids = {t: vr.get("values", []) for t, vr in zip(titles, value_ranges) if vr.get("values")}
+        return {"grids": grids, "history_dates": [d for d in hist_dates if d], "requests": stats["requests"]}
+
+    def write_tables(self, target, grids, synced):
+        return write_grids(lambda: self.open(target), grids, synced)
+
+    def history_dates(self, target):
+        dates = [norm_date(v) for v in api_call("sheets", self.worksheet(target, "History").col_values, 1)[1:]]
+        return [d for d in dates if d]
+
+    def append_history(self, target, row):
+        api_call("sheets", self.worksheet(target, "History").append_row, row)
+
+    def load_history(self, target):
+        return api_call("sheets", self.worksheet(target, "History").get_all_values)
+
+# 工作表 -> (SQLite 資料表, 欄位定義)；欄位順序與 SHEET_SCHEMA 相同，Settings 的值不限型別
+SQLITE_TABLES = {
+    "US_Stocks": ("us_stocks", ["code TEXT", "name TEXT", "shares REAL", "category TEXT", "custom_price REAL", "ref_price REAL"]),
+    "TW_Stocks": ("tw_stocks", ["code TEXT", "name TEXT", "shares REAL", "category TEXT", "custom_price REAL", "ref_price REAL"]),
+    "Fixed_Assets": ("fixed_assets", ["item TEXT", "value REAL", "category TEXT"]),
+    "Liabilities": ("liabilities", ["item TEXT", "amount REAL", "monthly REAL"]),
+    "Settings": ("settings", ["key TEXT", "value"]),
+}
+
+class SqliteBackend(StorageBackend):
+    # 本機 SQLite：每張表以 (target, row_no) 為主鍵保留列順序，寫入時只 upsert 變動的列
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        ddl = ["PRAGMA journal_mode=WAL;",
+               "CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password_hash TEXT NOT NULL, target TEXT NOT NULL) WITHOUT ROWID;",
+               """CREATE TABLE IF NOT EXISTS history (
+                    target TEXT NOT NULL, date TEXT NOT NULL, net_worth REAL, total_assets REAL,
+                    total_liabilities REAL, monthly_payment REAL, PRIMARY KEY (target, date)) WITHOUT ROWID;"""]
+        for table, cols in SQLITE_TABLES.values():
+            ddl.append(f"CREATE TABLE IF NOT EXISTS {table} (target TEXT NOT NULL, row_no INTEGER NOT NULL, {', '.join(cols)}, PRIMARY KEY (target, row_no)) WITHOUT ROWID;")
+        ddl += [f"CREATE INDEX IF NOT EXISTS idx_{t}_code ON {t} (code);" for t in ("us_stocks", "tw_stocks")]
+        with self.connect() as conn: conn.executescript("\n".join(ddl))
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn: yield conn
+        finally: conn.close()
+
+    def load_users(self):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT username, password_hash, target FROM users").fetchall()
+        return [{"Username": u, "Password_Hash": h, "Target_Sheet": t} for u, h, t in rows]
+
+    def upsert_user(self, username, password, target):
+        with self.connect() as conn:
+            conn.execute("INSERT INTO users VALUES (?, ?, ?) ON CONFLICT(username) DO UPDATE SET password_hash = excluded.password_hash, target = excluded.target",
+                         (str(username).strip(), hash_password(password), str(target).strip()))
+
+    def load_tables(self, target):
+        grids = {}
+        with self.connect() as conn:
+            for title, (table, defs) in SQLITE_TABLES.items():
+                cols = [d.split()[0] for d in defs]
+                rows = conn.execute(f"SELECT {', '.join(cols)} FROM {table} WHERE target = ? ORDER BY row_no", (target,)).fetchall()
+                grids[title] = [list(SHEET_SCHEMA[title])] + [["" if v is None else v for v in r] for r in rows]
+        return {"grids": grids, "history_dates": self.history_dates(target), "requests": 0}
+
+    def write_tables(self, target, grids, synced):
+        # 逐列比對：變動的列以 upsert 寫入、多出來的舊列刪除，所有表在同一個交易內完成
+        wrote = False
+        with self.connect() as conn:
+            for title, grid in grids.items():
+                table, cols = SQLITE_TABLES[title][0], [d.split()[0] for d in SQLITE_TABLES[title][1]]
+                new = sqlite_rows(title, grid)
+                old = sqlite_rows(title, synced[title]) if title in synced else None
+                changed = [i for i in range(len(new)) if old is None or i >= len(old) or [cell_key(v) for v in new[i]] != [cell_key(v) for v in old[i]]]
+                if changed:
+                    conn.executemany(f"INSERT INTO {table} (target, row_no, {', '.join(cols)}) VALUES ({', '.join('?' * (len(cols) + 2))}) "
+                                     f"ON CONFLICT(target, row_no) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in cols)}",
+                                     [(target, i, *new[i]) for i in changed])
+                if old is None or len(old) > len(new):
+                    conn.execute(f"DELETE FROM {table} WHERE target = ? AND row_no >= ?", (target, len(new)))
+                wrote = wrote or bool(changed) or (old is not None and len(old) > len(new))
+        synced.update(grids)
+        return wrote
+
+    def history_dates(self, target):
+        with self.connect() as conn:
+            return [d for (d,) in conn.execute("SELECT date FROM history WHERE target = ? ORDER BY date", (target,))]
+
+    def append_history(self, target, row):
+        with self.connect() as conn:
+            conn.execute("INSERT INTO history VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(target, date) DO UPDATE SET "
+                         "net_worth = excluded.net_worth, total_assets = excluded.total_assets, "
+                         "total_liabilities = excluded.total_liabilities, monthly_payment = excluded.monthly_payment",
+                         (target, norm_date(row[0]), *[float(v) for v in row[1:5]]))
+
+    def load_history(self, target):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT date, net_worth, total_assets, total_liabilities, monthly_payment FROM history WHERE target = ? ORDER BY date",
+                                (target,)).fetchall()
+        return [list(SHEET_SCHEMA["History"])] + [list(r) for r in rows]
+
+def sqlite_rows(title, grid):
+    # 二維陣列 -> 依 SHEET_SCHEMA 欄位順序排好的資料列 (依標題對應，缺少的欄位補空白)
+    if not grid: return []
+    header = [str(h) for h in grid[0]]
+    pos = [header.index(c) if c in header else None for c in SHEET_SCHEMA[title]]
+    return [[r[p] if p is not None and p < len(r) else "" for p in pos] for r in grid[1:]]
+
+@st.cache_resource
+def get_storage():
+    # NEXUS_STORAGE=sqlite 時改用本機 SQLite，不需要 Google 憑證與網路
+    if STORAGE_BACKEND == "sqlite": return SqliteBackend(SQLITE_STORAGE_PATH or os.path.join(CACHE_DIR, "nexus.db"))
+    return SheetsBackend(lambda: get_google_client())
 
 # --- 3. 資料邏輯 ---
 
+def grid_to_frame(grid, cols):
+    # 工作表二維陣列 -> DataFrame；API 會省略列尾空白儲存格，這裡補齊
+    if not grid: return pd.DataFrame(columns=cols)
+    header = [str(h) for h in grid[0]]
+    rows = [list(r) + [""] * (len(header) - len(r)) for r in grid[1:]]
+    df = pd.DataFrame([r[:len(header)] for r in rows], columns=header)
+    for c in cols:
+        if c not in df.columns: df[c] = ""
+    return df
+
 def load_data_from_cloud(target_sheet):
     try:
-        sh = init_user_sheet(target_sheet)
-        if not sh: return
+        started = time.perf_counter()
+        try: loaded = get_storage().load_tables(target_sheet)
+        except StorageNotFound:
+            st.error(f"❌ 找不到個人試算表：{target_sheet}")
+            st.info(f"請去 Google Drive 確認檔案存在，並分享給：\n\n**{get_service_email()}**")
+            st.stop()
+        st.session_state.last_history_date = max(loaded["history_dates"], default=None)
+        # 保留後端原始內容 (欄位順序與空白列) 作為之後比對變動的基準
+        raw_grids = loaded["grids"]
 
-        def read_ws(title, cols):
-            try:
-                data = sh.worksheet(title).get_all_records()
-                df = pd.DataFrame(data)
-                for c in cols:
-                    if c not in df.columns: df[c] = ""
-                return df
-            except: return pd.DataFrame(columns=cols)
-
-        st.session_state.us_data = read_ws("US_Stocks", ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"])
-        st.session_state.tw_data = read_ws("TW_Stocks", ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"])
-        st.session_state.fixed_data = read_ws("Fixed_Assets", ["資產項目", "現值", "類別"])
-        st.session_state.liab_data = read_ws("Liabilities", ["負債項目", "金額", "每月扣款"])
+        for title, key in SHEET_TABLES.items():
+            st.session_state[key] = grid_to_frame(raw_grids.get(title), SHEET_SCHEMA[title])
+        settings_df = grid_to_frame(raw_grids.get("Settings"), SHEET_SCHEMA["Settings"])
+        get_sync_queue(target_sheet).reset(raw_grids)
         
-        settings_df = read_ws("Settings", ["Key", "Value"])
         settings = dict(zip(settings_df['Key'], settings_df['Value'])) if not settings_df.empty else {}
         
         st.session_state.saved_expense = float(settings.get("expense", 850000))
@@ -168,216 +786,1381 @@ def load_data_from_cloud(target_sheet):
         st.session_state.saved_return = float(settings.get("return_rate", 11.0))
         st.session_state.saved_inflation = float(settings.get("inflation_rate", 3.0))
         
+        st.session_state.load_stats = {"requests": loaded["requests"], "seconds": time.perf_counter() - started}
         st.session_state.data_loaded = True
     except Exception as e: st.error(f"資料讀取錯誤: {e}")
 
-def save_data_to_cloud(target_sheet, silent=False):
-    try:
-        sh = init_user_sheet(target_sheet)
-        if not sh: return False
+def sheet_grid(title, df):
+    # 轉成要寫入工作表的二維陣列 (含標題列)；欄位順序固定，方便逐列比對
+    df_clean = pd.DataFrame(df).copy()
+    schema = SHEET_SCHEMA.get(title, [])
+    df_clean = df_clean[[c for c in schema if c in df_clean.columns] + [c for c in df_clean.columns if c not in schema]]
+    for c in df_clean.columns:
+        if c in NUM_COLS: df_clean[c] = pd.to_numeric(df_clean[c], errors='coerce').fillna(0)
+        elif title != "Settings": df_clean[c] = df_clean[c].astype(str).replace("nan", "")
 
-        def write_ws(title, df):
+    if "代號" in df_clean.columns:
+        df_clean = df_clean[
+            (df_clean["代號"].astype(str).str.strip() != "") & 
+            (df_clean["代號"].astype(str).str.strip().str.lower() != "nan")
+        ]
+    elif "資產項目" in df_clean.columns:
+        df_clean = df_clean[df_clean["資產項目"].astype(str).str.strip() != ""]
+    elif "負債項目" in df_clean.columns:
+        df_clean = df_clean[df_clean["負債項目"].astype(str).str.strip() != ""]
+
+    header = df_clean.columns.values.tolist()
+    if df_clean.empty: return [header]
+    return [header] + df_clean.fillna("").values.tolist()
+
+def settings_frame():
+    inf_rate = getattr(st.session_state, 'saved_inflation', 3.0)
+    return pd.DataFrame([
+        {"Key": "expense", "Value": st.session_state.saved_expense},
+        {"Key": "age", "Value": st.session_state.saved_age},
+        {"Key": "savings", "Value": st.session_state.saved_savings},
+        {"Key": "return_rate", "Value": st.session_state.saved_return},
+        {"Key": "inflation_rate", "Value": inf_rate}
+    ])
+
+def cell_key(v):
+    # 比對用：數字與數字字串 (例如 2330 / "2330" / "1,000") 視為相同
+    if isinstance(v, bool): return str(v)
+    if isinstance(v, (int, float)): return float(v)
+    s = str(v).strip()
+    try: return float(s.replace(",", ""))
+    except ValueError: return s
+
+def rowcol_to_a1(row, col):
+    # 同 gspread.utils.rowcol_to_a1 (1, 27 -> "AA1")；自己算以免為此載入 gspread
+    label = ""
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        label = chr(65 + rem) + label
+    return f"{label}{row}"
+
+def grid_diff_ranges(title, old, new):
+    # 逐列比對新舊內容，連續變動的列合併成一個範圍；新表較短時以空白覆蓋多出的舊列
+    width = max([len(r) for r in old + new] + [1])
+    pad = lambda r: list(r) + [""] * (width - len(r))
+    old_rows, new_rows = [pad(r) for r in old], [pad(r) for r in new]
+    blank = [""] * width
+    n = max(len(old_rows), len(new_rows))
+    row_key = lambda rows, i: [cell_key(x) for x in (rows[i] if i < len(rows) else blank)]
+    changed = [i for i in range(n) if row_key(old_rows, i) != row_key(new_rows, i)]
+
+    ranges, start = [], None
+    for j, i in enumerate(changed):
+        if start is None: start = i
+        if j + 1 == len(changed) or changed[j + 1] != i + 1:
+            values = [new_rows[k] if k < len(new_rows) else blank for k in range(start, i + 1)]
+            ranges.append({"range": f"'{title}'!A{start + 1}:{rowcol_to_a1(i + 1, width)}", "values": values})
+            start = None
+    return ranges
+
+def session_grids():
+    # 目前 session 的四張表與設定，轉成要寫回雲端的內容
+    grids = {title: sheet_grid(title, st.session_state[key]) for title, key in SHEET_TABLES.items()}
+    grids["Settings"] = sheet_grid("Settings", settings_frame())
+    return grids
+
+def write_grids(open_sheet, grids, synced):
+    # 只送出和上次同步內容 (synced) 不同的列；沒有基準的表整張重寫。成功後更新 synced
+    # 先比對再開啟試算表 (open_sheet)：沒有變動時完全不送出請求
+    data, unknown = [], []
+    for title, grid in grids.items():
+        old = synced.get(title)
+        if old is None:
+            unknown.append(f"'{title}'")
+            data.append({"range": f"'{title}'!A1", "values": grid})
+        else:
+            data += grid_diff_ranges(title, old, grid)
+
+    if data:
+        sh = open_sheet()
+        if unknown: api_call("sheets", sh.values_batch_clear, body={"ranges": unknown})
+        api_call("sheets", sh.values_batch_update, {"valueInputOption": "RAW", "data": data})
+    synced.update(grids)
+    return bool(data)
+
+# --- 背景同步佇列 (Auto-Sync) ---
+SYNC_DEBOUNCE_SECONDS = 2.0  # 最後一次編輯後等待多久才寫入，期間的編輯合併成一次
+SYNC_MAX_RETRIES = 5
+
+class SyncQueue:
+    # 每個目標試算表一個佇列；只保留最新一份快照，由背景執行緒透過儲存後端寫入
+    def __init__(self, target, storage):
+        self.target, self.storage = target, storage
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.synced = {}          # 雲端目前內容，作為 diff 基準
+        self.pending = None       # (grids, seq)
+        self.failed = None        # 重試用盡後保留的快照
+        self.last_submitted = None
+        self.seq = self.written_seq = 0  # 快照序號；較舊的快照不會覆蓋已寫入的新內容
+        self.due = 0.0
+        self.attempts = 0
+        self.status, self.error, self.synced_at = "synced", None, None
+        self.worker = None
+
+    def reset(self, grids):
+        # 重新從雲端載入後，以載入內容為新基準
+        with self.write_lock: self.synced = dict(grids)
+        with self.cond: self.last_submitted = None
+
+    def submit(self, grids):
+        with self.cond:
+            if grids == self.last_submitted: return
+            self.seq += 1
+            self.pending, self.last_submitted, self.failed = (grids, self.seq), grids, None
+            self.due = time.time() + SYNC_DEBOUNCE_SECONDS
+            self.status, self.attempts = "pending", 0
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+            self.cond.notify()
+
+    def retry(self):
+        with self.cond:
+            if self.failed: grids, _ = self.failed
+            else: return
+            self.last_submitted = None
+        self.submit(grids)
+
+    def write_now(self, grids):
+        # 手動存檔：直接寫入，並取代佇列中尚未寫出的快照
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            self.pending, self.failed, self.last_submitted = None, None, grids
+        try:
+            with self.write_lock:
+                wrote = self.storage.write_tables(self.target, grids, self.synced)
+                self.written_seq = max(self.written_seq, seq)
+        except Exception as e:
+            # 寫入失敗：這份快照 (含被取代的佇列內容) 保留給重試按鈕，除非期間又有更新的快照排入
+            with self.cond:
+                self.error = str(e)
+                if self.pending is None: self.status, self.failed = "failed", (grids, seq)
+            raise
+        with self.cond:
+            if self.pending is None: self.status, self.error, self.synced_at = "synced", None, time.time()
+        return wrote
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.pending is None:
+                    self.cond.wait(timeout=60)
+                    if self.pending is None:
+                        self.worker = None
+                        return
+                    continue
+                wait = self.due - time.time()
+                if wait > 0:
+                    self.cond.wait(timeout=wait)
+                    continue
+                grids, seq = self.pending
+                self.pending = None
             try:
-                ws = sh.worksheet(title)
-                ws.clear()
-                
-                df_clean = df.copy()
-                num_cols = ["股數", "現值", "金額", "自訂價格", "參考市價", "每月扣款"]
-                for c in num_cols:
-                    if c in df_clean.columns:
-                        df_clean[c] = pd.to_numeric(df_clean[c], errors='coerce').fillna(0)
-
-                if "代號" in df_clean.columns:
-                    df_clean = df_clean[
-                        (df_clean["代號"].astype(str).str.strip() != "") & 
-                        (df_clean["代號"].astype(str).str.strip().str.lower() != "nan")
-                    ]
-                elif "資產項目" in df_clean.columns:
-                    df_clean = df_clean[df_clean["資產項目"].astype(str).str.strip() != ""]
-                elif "負債項目" in df_clean.columns:
-                    df_clean = df_clean[df_clean["負債項目"].astype(str).str.strip() != ""]
-
-                if not df_clean.empty:
-                    df_clean = df_clean.fillna("")
-                    ws.update([df_clean.columns.values.tolist()] + df_clean.values.tolist())
-                else: 
-                    ws.update([df.columns.values.tolist()])
+                with self.write_lock:
+                    if seq > self.written_seq:
+                        self.storage.write_tables(self.target, grids, self.synced)
+                        self.written_seq = seq
+                with self.cond:
+                    if self.pending is None: self.status, self.error, self.synced_at, self.attempts = "synced", None, time.time(), 0
             except Exception as e:
-                if not silent: st.warning(f"寫入 {title} 失敗: {e}")
+                with self.cond:
+                    self.error = str(e)
+                    if self.pending is not None: continue  # 已有更新的快照，直接改寫新的
+                    if isinstance(e, CircuitOpen):
+                        # 斷路中：等冷卻結束再寫，不算重試次數，快照不會因此被放棄
+                        self.pending, self.due = (grids, seq), e.retry_at
+                        continue
+                    self.attempts += 1
+                    if self.attempts >= SYNC_MAX_RETRIES:
+                        self.status, self.failed = "failed", (grids, seq)
+                    else:
+                        self.pending = (grids, seq)
+                        self.due = time.time() + min(60, 2 ** self.attempts) * random.uniform(0.8, 1.2)
 
-        write_ws("US_Stocks", pd.DataFrame(st.session_state.us_data))
-        write_ws("TW_Stocks", pd.DataFrame(st.session_state.tw_data))
-        write_ws("Fixed_Assets", pd.DataFrame(st.session_state.fixed_data))
-        write_ws("Liabilities", pd.DataFrame(st.session_state.liab_data))
-        
-        inf_rate = getattr(st.session_state, 'saved_inflation', 3.0)
-        
-        settings_data = pd.DataFrame([
-            {"Key": "expense", "Value": st.session_state.saved_expense},
-            {"Key": "age", "Value": st.session_state.saved_age},
-            {"Key": "savings", "Value": st.session_state.saved_savings},
-            {"Key": "return_rate", "Value": st.session_state.saved_return},
-            {"Key": "inflation_rate", "Value": inf_rate}
-        ])
-        write_ws("Settings", settings_data)
+@st.cache_resource
+def get_sync_queues():
+    return {}
+
+def get_sync_queue(target_sheet):
+    queues = get_sync_queues()
+    if target_sheet not in queues: queues[target_sheet] = SyncQueue(target_sheet, get_storage())
+    return queues[target_sheet]
+
+def queue_cloud_sync(target_sheet):
+    # Auto-Sync：交給背景佇列，不在 rerun 執行緒上等待儲存後端
+    get_sync_queue(target_sheet).submit(session_grids())
+
+def save_data_to_cloud(target_sheet, silent=False):
+    try:
+        wrote = get_sync_queue(target_sheet).write_now(session_grids())
         
         if not silent:
-            st.toast("✅ 雲端同步完成", icon="☁️")
+            st.toast("✅ 雲端同步完成" if wrote else "✅ 雲端資料已是最新", icon="☁️")
         return True
         
     except Exception as e:
         if not silent: st.error(f"⚠️ 存檔失敗，請檢查網路連線: {e}")
         return False
 
+SYNC_POLL_SECONDS = 2  # 等待同步期間狀態列的輪詢間隔
+
+def sync_status_panel(target_sheet):
+    # 只有等待同步時才定時輪詢；已同步或失敗時不掛計時器，閒置的 session 不會一直 rerun
+    polling = get_sync_queue(target_sheet).status == "pending"
+    st.fragment(sync_status_body, run_every=SYNC_POLL_SECONDS if polling else None)(target_sheet, polling)
+
+@metered("fragment.sync_status")
+def sync_status_body(target_sheet, polling):
+    q = get_sync_queue(target_sheet)
+    if polling and q.status != "pending": st.rerun()  # 寫入結束：整頁 rerun 一次以取消輪詢並更新卡片
+    if q.status == "pending":
+        st.caption("⏳ 等待同步 (pending)")
+    elif q.status == "failed":
+        st.caption(f"❌ 同步失敗 (failed)：{q.error}")
+        if st.button("🔁 重試同步"):
+            q.retry()
+            st.rerun()
+    elif q.synced_at:
+        st.caption(f"✅ 已同步 (synced) · {time.strftime('%H:%M:%S', time.localtime(q.synced_at))}")
+
+def norm_date(v):
+    # History 的日期可能是 "2024-01-31" 字串或格式化過的日期，統一成 YYYY-MM-DD
+    try:
+        d = pd.to_datetime(str(v).strip())
+        return None if pd.isna(d) else str(d.date())
+    except: return None
+
+HISTORY_RETRY_SECONDS = 300  # 今日紀錄寫入失敗後，這個 session 隔多久再試 (不在每次 rerun 都卡在重試退避上)
+
 def save_daily_record_cloud(target_sheet, net_worth, assets, liabilities, monthly_payment):
+    # 最後紀錄日期在登入時隨 batchGet 一併讀回，之後每次 rerun 只比對 session 標記
     today = str(date.today())
+    if st.session_state.get("last_history_date") == today: return
+    if time.time() < st.session_state.get("history_retry_at", 0): return
+    storage = get_storage()
+    if storage.name == "sheets" and get_schedulers()["sheets"].state() == "open": return  # 斷路中：等冷卻結束再寫
     try:
-        sh = init_user_sheet(target_sheet)
-        if not sh: return
-        ws = sh.worksheet("History")
-        try:
-            records = ws.get_all_records()
-            df = pd.DataFrame(records)
-            if not df.empty and str(today) in df['Date'].astype(str).values: return
-        except: pass
-        ws.append_row([today, net_worth, assets, liabilities, monthly_payment])
-    except: pass
+        if "last_history_date" not in st.session_state:
+            st.session_state.last_history_date = max(storage.history_dates(target_sheet), default=None)
+            if st.session_state.last_history_date == today: return
+        storage.append_history(target_sheet, [today, net_worth, assets, liabilities, monthly_payment])
+        st.session_state.last_history_date = today
+    except Exception as e:
+        # 限流、斷路、網路、Sheets API 或找不到檔案：記錄指標並提示，稍後再試；其他錯誤照常拋出
+        # APIError 只比對類別名稱，sqlite 後端不必為了 except 載入 gspread
+        if not (is_transient(e) or isinstance(e, (CircuitOpen, StorageNotFound, sqlite3.Error)) or type(e).__name__ == "APIError"): raise
+        st.session_state.history_retry_at = max(getattr(e, "retry_at", 0), time.time() + HISTORY_RETRY_SECONDS)
+        get_perf_metrics().record("history.append_failed", 0.0)
+        st.toast(f"⚠️ 今日淨值紀錄寫入失敗，{HISTORY_RETRY_SECONDS // 60} 分鐘後重試：{e}", icon="📉")
 
-def fetch_smart_ticker_data(symbol):
+def candidate_symbols(symbol):
+    # 依序嘗試：原始代號 -> 上市 .TW -> 上櫃 .TWO -> 加密貨幣 -USD
     symbol = str(symbol).strip().upper()
-    t = yf.Ticker(symbol)
-    try:
-        hist = t.history(period="1d")
-        if not hist.empty:
-            return hist['Close'].iloc[-1], symbol, t.info.get('shortName', symbol)
-    except: pass
+    cands = [symbol]
+    if symbol.isdigit(): cands += [f"{symbol}.TW", f"{symbol}.TWO"]
+    if len(symbol) <= 5 and symbol.isalpha(): cands.append(f"{symbol}-USD")
+    return cands
 
-    if symbol.isdigit():
-        try_sym = f"{symbol}.TW"
-        t = yf.Ticker(try_sym)
+# --- 代號解析快取 (磁碟) ---
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".nexus_cache")
+RESOLVE_CACHE_TTL = 30 * 86400  # 代號解析結果保留 30 天
+
+class TickerResolutionCache:
+    # 原始代號 -> (有效代號, 名稱)，例如 "2330" -> ("2330.TW", "TSMC")
+    def __init__(self, path, ttl=RESOLVE_CACHE_TTL):
+        self.path, self.ttl = path, ttl
+        self.lock = threading.Lock()
         try:
-            hist = t.history(period="1d")
-            if not hist.empty:
-                return hist['Close'].iloc[-1], try_sym, t.info.get('shortName', try_sym)
-        except: pass
-        
-        try_sym = f"{symbol}.TWO"
-        t = yf.Ticker(try_sym)
+            with open(path, encoding="utf-8") as fp: self.entries = json.load(fp)
+        except: self.entries = {}
+
+    def get(self, raw):
+        with self.lock:
+            entry = self.entries.get(str(raw).strip().upper())
+        if not entry or time.time() - entry.get("ts", 0) > self.ttl: return None
+        return entry["symbol"], entry.get("name", "")
+
+    def put_many(self, items):
+        # items: {原始代號: (有效代號, 名稱)}；名稱為空時保留舊名稱
+        if not items: return
+        now = time.time()
+        with self.lock:
+            for raw, (symbol, name) in items.items():
+                old = self.entries.get(raw, {})
+                if not name and old.get("symbol") == symbol: name = old.get("name", "")
+                self.entries[raw] = {"symbol": symbol, "name": name, "ts": now}
+            self._save()
+
+    def invalidate(self, raw=None):
+        # 不指定代號時清空整個快取
+        with self.lock:
+            if raw is None: self.entries = {}
+            else: self.entries.pop(str(raw).strip().upper(), None)
+            self._save()
+
+    def _save(self):
         try:
-            hist = t.history(period="1d")
-            if not hist.empty:
-                return hist['Close'].iloc[-1], try_sym, t.info.get('shortName', try_sym)
-        except: pass
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fp: json.dump(self.entries, fp, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError: pass
+
+@st.cache_resource
+def get_resolution_cache():
+    return TickerResolutionCache(os.path.join(CACHE_DIR, "ticker_resolution.json"))
+
+# --- 代號總表 (離線解析與搜尋) ---
+SYMBOL_MASTER_PATH = os.environ.get("NEXUS_SYMBOL_MASTER")  # 預設 .nexus_cache/symbol_master.tsv；以 python app.py symbols refresh 重建
+SYMBOL_SOURCES = [  # (市場, 清單網址, 有效代號後綴)；同一個代號以先出現的市場為準，與 candidate_symbols 的嘗試順序相同
+    ("US", "https://www.nasdaqtrader.com/dynamic/SymDir/nasdaqlisted.txt", ""),
+    ("US", "https://www.nasdaqtrader.com/dynamic/SymDir/otherlisted.txt", ""),
+    ("TWSE", "https://openapi.twse.com.tw/v1/exchangeReport/STOCK_DAY_ALL", ".TW"),
+    ("TPEX", "https://www.tpex.org.tw/openapi/v1/tpex_mainboard_daily_close_quotes", ".TWO"),
+]
+CRYPTO_NAMES = {"BTC": "Bitcoin", "ETH": "Ethereum", "USDT": "Tether", "BNB": "BNB", "SOL": "Solana", "XRP": "XRP",
+                "USDC": "USD Coin", "DOGE": "Dogecoin", "ADA": "Cardano", "TRX": "TRON", "AVAX": "Avalanche", "SHIB": "Shiba Inu",
+                "TON": "Toncoin", "LINK": "Chainlink", "DOT": "Polkadot", "BCH": "Bitcoin Cash", "LTC": "Litecoin", "XLM": "Stellar",
+                "UNI": "Uniswap", "ATOM": "Cosmos", "ETC": "Ethereum Classic", "NEAR": "NEAR Protocol", "APT": "Aptos",
+                "FIL": "Filecoin", "ARB": "Arbitrum", "OP": "Optimism", "SUI": "Sui", "PEPE": "Pepe", "HBAR": "Hedera"}
+
+def parse_symbol_listing(text, suffix):
+    # 回傳 [(顯示代號, 有效代號, 名稱)]；證交所 / 櫃買中心為 JSON，nasdaqtrader 為 | 分隔文字檔
+    rows = []
+    if suffix:
+        for item in json.loads(text):
+            code = str(item.get("Code") or item.get("SecuritiesCompanyCode") or "").strip().upper()
+            name = str(item.get("Name") or item.get("CompanyName") or "").strip()
+            if re.fullmatch(r"[0-9][0-9A-Z]{3,5}", code): rows.append((code, f"{code}{suffix}", name))
+        return rows
+    lines = text.splitlines()
+    header = lines[0].split("|")
+    sym_col = header.index("Symbol" if "Symbol" in header else "ACT Symbol")
+    name_col, test_col = header.index("Security Name"), header.index("Test Issue")
+    for line in lines[1:]:
+        f = line.split("|")
+        if len(f) != len(header) or f[test_col] == "Y": continue  # 最後一行是檔案產生時間；測試代號略過
+        code = f[sym_col].strip().upper()
+        if not re.fullmatch(r"[A-Z][A-Z0-9.]*", code): continue  # 特別股 ($)、權證 (+) 等 Yahoo 代號寫法不同，略過
+        sym = code.replace(".", "-")  # BRK.B -> BRK-B
+        rows.append((sym, sym, f[name_col].split(" - ")[0].strip()))
+    return rows
+
+def http_get(url, timeout=30):
+    import urllib.request  # 只有重建代號總表時才需要
+    req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0 (NEXUS symbol master)"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp: return resp.read().decode("utf-8-sig")
+
+class SymbolMaster:
+    # 代號總表：顯示代號 -> (有效代號, 名稱, 市場)，依代號排序並另建名稱排序，以二分搜尋做前綴查詢
+    COLUMNS = ["code", "symbol", "name", "market"]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                rows = [line.rstrip("\n").split("\t") for line in fp][1:]
+            mtime = os.path.getmtime(self.path)
+        except OSError: rows, mtime = [], None
+        self.build([r for r in rows if len(r) == 4], mtime)
+
+    def build(self, rows, mtime=None):
+        rows = sorted(rows)
+        codes, symbols, names, markets = (list(c) for c in zip(*rows)) if rows else ([], [], [], [])
+        index = {}
+        for i, (code, sym) in enumerate(zip(codes, symbols)):
+            index.setdefault(code, i)
+            index.setdefault(sym, i)
+        for i, code in enumerate(codes):  # 加密貨幣也可以只打 BTC，但上市代號優先 (同 candidate_symbols 的順序)
+            if markets[i] == "CRYPTO": index.setdefault(code.removesuffix("-USD"), i)
+        order = sorted(range(len(names)), key=lambda i: names[i].casefold())
+        with self.lock:
+            self.codes, self.symbols, self.names, self.markets, self.index = codes, symbols, names, markets, index
+            self.name_keys, self.name_order = [names[i].casefold() for i in order], order
+            self.mtime = mtime
+
+    def reload_if_changed(self):
+        # symbols refresh 在另一個 process 重建檔案後，執行中的 server 下次查詢時自動載入
+        try: mtime = os.path.getmtime(self.path)
+        except OSError: mtime = None
+        if mtime != self.mtime: self.load()
+
+    @property
+    def size(self): return len(self.codes)
+
+    def rows(self):
+        with self.lock: return list(zip(self.codes, self.symbols, self.names, self.markets))
+
+    def lookup(self, raw):
+        # 回傳 (有效代號, 名稱)；BRK.B 這類以點分隔的美股代號也可以查到
+        # 與 build 同一把鎖：背景預抓與 session 同時查詢時，不會讀到換到一半的 index 與欄位
+        raw = str(raw).strip().upper()
+        with self.lock:
+            i = self.index.get(raw)
+            if i is None and "." in raw: i = self.index.get(raw.replace(".", "-"))
+            return None if i is None else (self.symbols[i], self.names[i])
+
+    def search(self, query, markets=None, limit=20):
+        # 代號前綴優先，其次名稱前綴 (不分大小寫)；回傳 [(顯示代號, 名稱, 市場)]
+        q = str(query).strip()
+        if not q: return []
+        self.reload_if_changed()
+        with self.lock:
+            hits, seen = [], set()
+            def take(i):
+                if i in seen or (markets and self.markets[i] not in markets): return
+                seen.add(i)
+                hits.append((self.codes[i], self.names[i], self.markets[i]))
+            up = q.upper()
+            i = bisect.bisect_left(self.codes, up)
+            while i < len(self.codes) and self.codes[i].startswith(up) and len(hits) < limit:
+                take(i)
+                i += 1
+            fold = q.casefold()
+            j = bisect.bisect_left(self.name_keys, fold)
+            while j < len(self.name_keys) and self.name_keys[j].startswith(fold) and len(hits) < limit:
+                take(self.name_order[j])
+                j += 1
+        return hits
 
-    if len(symbol) <= 5 and symbol.isalpha():
-        try_sym = f"{symbol}-USD"
+    def refresh(self, fetch=http_get):
+        # 從各交易所清單重建並寫回檔案；下載失敗的來源沿用舊表中同市場的資料
+        # 回傳 {市場: (筆數, 錯誤訊息或 None)}
+        old = self.rows()
+        rows, report, seen = [], {}, set()
+        def add(market, items):
+            added = 0
+            for code, sym, name in items:
+                if code not in seen:
+                    seen.add(code)
+                    rows.append((code, sym, name, market))
+                    added += 1
+            return added
+        for market, url, suffix in SYMBOL_SOURCES:
+            n, err = report.get(market, (0, None))
+            try: items = parse_symbol_listing(fetch(url), suffix)
+            except Exception as e:
+                items, err = [r[:3] for r in old if r[3] == market], err or f"{url}: {str(e) or type(e).__name__}"
+            report[market] = (n + add(market, items), err)
+        report["CRYPTO"] = (add("CRYPTO", [(f"{c}-USD", f"{c}-USD", name) for c, name in CRYPTO_NAMES.items()]), None)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            fp.write("\t".join(self.COLUMNS) + "\n")
+            for r in sorted(rows): fp.write("\t".join(v.replace("\t", " ") for v in r) + "\n")
+        os.replace(tmp, self.path)
+        self.load()
+        return report
+
+@st.cache_resource
+def get_symbol_master():
+    return SymbolMaster(SYMBOL_MASTER_PATH or os.path.join(CACHE_DIR, "symbol_master.tsv"))
+
+def known_symbols(symbols):
+    # 原始代號 -> (有效代號, 名稱) 或 None：先查解析快取 (實際下載驗證過)，再查代號總表，兩者都不需要網路
+    cache, master = get_resolution_cache(), get_symbol_master()
+    master.reload_if_changed()
+    return {s: cache.get(s) or master.lookup(s) for s in symbols}
+
+# --- 報價快取 (跨 session 共用) ---
+QUOTE_FRESH_SECONDS = float(os.environ.get("NEXUS_QUOTE_TTL", 60))   # 開盤中 (及 24 小時市場) 的報價新鮮期 (秒)
+QUOTE_CACHE_MAX = int(os.environ.get("NEXUS_QUOTE_CACHE_MAX", 20000))  # 最多保留幾檔，超過時淘汰最久未用；需涵蓋背景預抓的所有代號
+MARKET_HOURS = {  # 市場 -> (時區, 開盤, 收盤)，週一至週五；國定假日照常視為開盤，只是多抓幾次
+    "TW": ("Asia/Taipei", dtime(9, 0), dtime(13, 30)),
+    "US": ("America/New_York", dtime(9, 30), dtime(16, 0)),
+}
+MARKET_CLOSE_GRACE = 15 * 60     # 收盤後多久抓到的價格才算收盤價
+OTHER_MARKET_SECONDS = 3600      # 其他交易所 (.T、.HK…) 不判斷開收盤，固定每小時更新
+
+def symbol_market(sym):
+    # 有效代號 -> 市場：.TW/.TWO 台股、-USD 之類的幣對與匯率 24 小時、其他後綴另計，其餘視為美股 (BRK-B 仍是美股)
+    sym = str(sym).upper()
+    if sym.endswith((".TW", ".TWO")): return "TW"
+    if re.search(r"-[A-Z]{3}$", sym) or sym.endswith("=X"): return "24H"
+    if "." in sym: return "OTHER"
+    return "US"
+
+def market_clock(now=None):
+    # 各市場 -> (目前是否開盤, 最近一次收盤的 epoch 秒)
+    now = time.time() if now is None else now
+    clock = {}
+    for market, (tz, open_t, close_t) in MARKET_HOURS.items():
+        zone = ZoneInfo(tz)
+        local = datetime.fromtimestamp(now, zone)
+        day = local.date()
+        while day.weekday() >= 5 or datetime.combine(day, close_t, zone).timestamp() > now: day -= timedelta(days=1)
+        clock[market] = (local.weekday() < 5 and open_t <= local.time() < close_t, datetime.combine(day, close_t, zone).timestamp())
+    return clock
+
+def quote_is_fresh(sym, fetched_at, now, clock, fresh_seconds=QUOTE_FRESH_SECONDS):
+    # 開盤中與 24 小時市場看秒數；已收盤的市場只要是收盤後抓的就一直算新鮮，直到下次開盤
+    market = symbol_market(sym)
+    if market in clock:
+        is_open, last_close = clock[market]
+        if is_open or now < last_close + MARKET_CLOSE_GRACE: return now - fetched_at <= fresh_seconds
+        return fetched_at >= last_close + MARKET_CLOSE_GRACE
+    return now - fetched_at <= (fresh_seconds if market == "24H" else OTHER_MARKET_SECONDS)
+
+class QuoteCache:
+    # 有效代號 -> (價格, 取得時間)；過期的報價先回傳舊值，再於背景更新
+    def __init__(self, fresh_seconds=QUOTE_FRESH_SECONDS, max_entries=QUOTE_CACHE_MAX):
+        self.fresh_seconds, self.max_entries = fresh_seconds, max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.hits = self.stale_hits = self.misses = self.fetched = 0
+
+    def lookup(self, symbols):
+        # 回傳 (新鮮報價, 過期報價, 未命中代號)；新鮮與否依各代號市場的開收盤判斷
+        fresh, stale, missing = {}, {}, []
+        now = time.time()
+        clock = market_clock(now)
+        with self.lock:
+            for sym in symbols:
+                entry = self.entries.get(sym)
+                if entry is None:
+                    missing.append(sym)
+                    continue
+                self.entries.move_to_end(sym)
+                if quote_is_fresh(sym, entry[1], now, clock, self.fresh_seconds): fresh[sym] = entry[0]
+                else: stale[sym] = entry[0]
+            self.hits += len(fresh)
+            self.stale_hits += len(stale)
+            self.misses += len(missing)
+        return fresh, stale, missing
+
+    def due(self, symbols):
+        # 沒有報價或已不新鮮的代號；給背景預抓用，不計入命中率
+        now = time.time()
+        clock = market_clock(now)
+        with self.lock: entries = {s: self.entries.get(s) for s in symbols}
+        return [s for s, e in entries.items() if e is None or not quote_is_fresh(s, e[1], now, clock, self.fresh_seconds)]
+
+    def put_many(self, prices):
+        now = time.time()
+        with self.lock:
+            for sym, price in prices.items():
+                self.entries[sym] = (float(price), now)
+                self.entries.move_to_end(sym)
+            self.fetched += len(prices)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+    def revalidate(self, symbols):
+        # 背景批次更新過期報價；同一代號同時只會有一個更新在進行
+        with self.lock:
+            todo = [s for s in symbols if s not in self.refreshing]
+            self.refreshing.update(todo)
+        if not todo: return
+
+        def worker():
+            try:
+                for i in range(0, len(todo), QUOTE_BATCH_SIZE):
+                    try: self.put_many(download_closes(todo[i:i + QUOTE_BATCH_SIZE]))
+                    except Exception: pass
+            finally:
+                with self.lock: self.refreshing.difference_update(todo)
+        threading.Thread(target=worker, daemon=True).start()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "stale_hits": self.stale_hits,
+                    "misses": self.misses, "fetched": self.fetched,
+                    "hit_rate": (self.hits + self.stale_hits) / total if total else 0.0}
+
+@st.cache_resource
+def get_quote_cache():
+    return QuoteCache()
+
+def fetch_smart_ticker_data(symbol):
+    symbol = str(symbol).strip().upper()
+    cache = get_resolution_cache()
+    cached = known_symbols([symbol])[symbol]
+    if cached and cached[1]:
+        fresh, stale, _ = get_quote_cache().lookup([cached[0]])
+        if stale: get_quote_cache().revalidate(list(stale))
+        price = fresh.get(cached[0], stale.get(cached[0]))
+        if price: return price, cached[0], cached[1]
+    cands = candidate_symbols(symbol)
+    if cached: cands = [cached[0]] + [c for c in cands if c != cached[0]]
+    for try_sym in cands:
         t = yf.Ticker(try_sym)
         try:
-            hist = t.history(period="1d")
+            hist = api_call("yf", t.history, period="1d")
             if not hist.empty:
-                return hist['Close'].iloc[-1], try_sym, t.info.get('shortName', try_sym)
-        except: pass
-        
+                name = cached[1] if cached and cached[0] == try_sym and cached[1] else api_call("yf", lambda: t.info).get('shortName', try_sym)
+                cache.put_many({symbol: (try_sym, name), try_sym: (try_sym, name)})
+                get_quote_cache().put_many({try_sym: hist['Close'].iloc[-1]})
+                return hist['Close'].iloc[-1], try_sym, name
+        except Exception as e:
+            if is_transient(e) or isinstance(e, CircuitOpen): break  # 被限流時換後綴也沒用
     return 0.0, symbol, ""
 
-def update_portfolio_data(df, category_default):
+# --- 批次報價引擎 ---
+QUOTE_BATCH_SIZE = 50   # 每次 yf.download 的代號數
+QUOTE_MAX_WORKERS = 8   # 零散查詢 (名稱 / 下載失敗) 的執行緒上限
+
+def download_closes(symbols):
+    # 一次下載多檔，回傳 {代號: 最新收盤價}；無資料的代號不會出現在結果中
+    closes = {}
+    if not symbols: return closes
+    data = yf_download(symbols, period="5d", interval="1d")
+    if data is None or data.empty: return closes
+    close = data["Close"]
+    if isinstance(close, pd.Series): close = close.to_frame(symbols[0])
+    last = close.ffill().iloc[-1]
+    for sym, val in last.items():
+        if pd.notna(val) and float(val) > 0: closes[str(sym)] = float(val)
+    return closes
+
+def fetch_short_name(symbol):
+    try: return api_call("yf", lambda: yf.Ticker(symbol).info).get('shortName', symbol)
+    except Exception: return symbol
+
+def fetch_quotes_batch(symbols, need_names=(), progress=None):
+    # 回傳 {原始代號(大寫): (價格, 有效代號, 名稱)}，格式與 fetch_smart_ticker_data 相同
+    # 每一輪只嘗試各代號的下一個候選後綴，並以 QUOTE_BATCH_SIZE 分批下載
+    raw = list(dict.fromkeys(s for s in (str(x).strip().upper() for x in symbols) if s and s != "NAN"))
+    need_names = {str(x).strip().upper() for x in need_names}
+    # 先查解析快取與代號總表：已知的代號直接從有效代號開始，其餘後綴只在失效時才嘗試
+    cache = get_resolution_cache()
+    known = known_symbols(raw)
+    # 已解析的代號再查報價快取：新鮮的直接使用，過期的先用舊價並排入背景更新
+    quote_cache = get_quote_cache()
+    fresh, stale, _ = quote_cache.lookup(list(dict.fromkeys(k[0] for k in known.values() if k)))
+    if stale: quote_cache.revalidate(list(stale))
+    results, leftovers = {}, []
+    pending = {}
+    for s in raw:
+        cands = candidate_symbols(s)
+        if known[s]:
+            sym = known[s][0]
+            if sym in fresh or sym in stale:
+                results[s] = (fresh.get(sym, stale.get(sym)), sym, known[s][1])
+                continue
+            cands = [sym] + [c for c in cands if c != sym]
+        pending[s] = cands
+    round_no = 0
+    while pending:
+        round_no += 1
+        wave = list(dict.fromkeys(c[0] for c in pending.values()))
+        batches = [wave[i:i + QUOTE_BATCH_SIZE] for i in range(0, len(wave), QUOTE_BATCH_SIZE)]
+        found, failed = {}, set()
+        for i, batch in enumerate(batches, 1):
+            try:
+                closes = download_closes(batch)
+                quote_cache.put_many(closes)
+                found.update(closes)
+            except Exception: failed.update(batch)
+            if progress: progress(i / len(batches), f"第 {round_no} 輪：批次 {i}/{len(batches)} ({len(batch)} 檔)")
+        next_pending = {}
+        for s, cands in pending.items():
+            if cands[0] in found:
+                name = known[s][1] if known[s] and known[s][0] == cands[0] else ""
+                results[s] = (found[cands[0]], cands[0], name)
+            elif cands[0] in failed: leftovers.append(s)
+            elif len(cands) > 1: next_pending[s] = cands[1:]
+        pending = next_pending
+
+    # 批次下載失敗的代號改走逐檔探測；缺名稱的代號查 shortName，兩者共用同一個執行緒池
+    name_jobs = [s for s, r in results.items() if s in need_names and not r[2]]
+    if leftovers or name_jobs:
+        if progress: progress(1.0, f"補查 {len(leftovers)} 檔報價 / {len(name_jobs)} 檔名稱...")
+        with ThreadPoolExecutor(max_workers=QUOTE_MAX_WORKERS) as pool:
+            probe = dict(zip(leftovers, pool.map(fetch_smart_ticker_data, leftovers)))
+            names = dict(zip(name_jobs, pool.map(fetch_short_name, [results[s][1] for s in name_jobs])))
+        for s, (price, sym, name) in probe.items():
+            if price > 0: results[s] = (float(price), sym, name)
+        for s, name in names.items():
+            price, sym, _ = results[s]
+            results[s] = (price, sym, name)
+
+    resolved = {}
+    for s, (_, sym, name) in results.items():
+        resolved[s] = resolved[sym] = (sym, name)
+    cache.put_many(resolved)
+    return results
+
+def portfolio_symbols(df):
+    # 取出表格中有效的代號，以及名稱欄空白、需要查名稱的代號
+    df = pd.DataFrame(df)
+    if df.empty or "代號" not in df.columns: return [], []
+    tickers = df["代號"].astype(str).str.strip()
+    valid = (tickers != "") & (tickers.str.lower() != "nan") & (tickers != "None")
+    names = df["名稱"] if "名稱" in df.columns else pd.Series("", index=df.index)
+    blank = names.isna() | (names.astype(str).str.strip() == "")
+    return tickers[valid].tolist(), tickers[valid & blank].tolist()
+
+# --- 背景報價預抓 (跨 session 共用) ---
+PREFETCH_ENABLED = os.environ.get("NEXUS_PREFETCH", "1") != "0"
+PREFETCH_TICK_SECONDS = 15          # 背景執行緒每隔多久檢查一次哪些報價需要更新
+PREFETCH_SESSION_TTL = 30 * 60      # session 多久沒有 rerun 就不再替它預抓
+PREFETCH_RETRY_SECONDS = 3600       # 解析不到或沒有報價的代號隔多久再試
+
+class SymbolRegistry:
+    # session -> (持有的原始代號, 最後活動時間)；背景預抓只處理仍在活動的 session
+    def __init__(self, ttl=PREFETCH_SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def update(self, session, symbols):
+        symbols = frozenset(s for s in (str(x).strip().upper() for x in symbols) if s and s != "NAN")
+        with self.lock: self.sessions[session] = (symbols, time.time())
+
+    def touch(self, session):
+        # 只 rerun fragment 的 session 也算活動中，代號不變只更新時間
+        with self.lock:
+            if session in self.sessions: self.sessions[session] = (self.sessions[session][0], time.time())
+
+    def drop(self, session):
+        with self.lock: self.sessions.pop(session, None)
+
+    def symbols(self):
+        # 活動中 session 的原始代號聯集；順便移除過期的 session
+        now = time.time()
+        with self.lock:
+            for s in [s for s, (_, seen) in self.sessions.items() if now - seen > self.ttl]: del self.sessions[s]
+            return set().union(*(syms for syms, _ in self.sessions.values()))
+
+    def active(self):
+        with self.lock: return len(self.sessions)
+
+@st.cache_resource
+def get_symbol_registry():
+    return SymbolRegistry()
+
+class PriceDaemon:
+    # server process 內唯一的背景執行緒：每輪收集活動中 session 的代號，依各市場開收盤挑出需要更新的報價，
+    # 每個有效代號每輪最多下載一次 (分批並經過 yf 排程器)，寫入共用報價快取；UPDATE PRICES 只需套用快取
+    def __init__(self, registry, tick=PREFETCH_TICK_SECONDS):
+        self.registry, self.tick = registry, tick
+        self.lock = threading.Lock()
+        self.worker = None
+        self.retry_at = {}  # 解析不到或沒有報價的代號 -> 下次再試的時間
+        self.tracked = self.fetched = self.cycles = 0
+        self.last_run, self.error = None, None
+
+    def ensure_started(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._loop, daemon=True)
+                self.worker.start()
+
+    def _loop(self):
+        while True:
+            try: self.run_once()
+            except Exception as e: self.error = str(e)
+            time.sleep(self.tick)
+
+    def run_once(self):
+        # 跑一輪預抓，回傳這輪下載的代號數
+        raw = self.registry.symbols()
+        quotes, now = get_quote_cache(), time.time()
+        known = known_symbols(raw)
+        symbols = sorted({k[0] for k in known.values() if k})
+        # 只保留仍被追蹤的代號 (原始或有效代號)；離開的 session 留下的重試時間不會一直累積
+        live = raw | set(symbols)
+        self.retry_at = {s: t for s, t in self.retry_at.items() if s in live}
+        todo = [s for s in quotes.due(symbols) if self.retry_at.get(s, 0) <= now]
+        fetched = 0
+        for i in range(0, len(todo), QUOTE_BATCH_SIZE):
+            batch = todo[i:i + QUOTE_BATCH_SIZE]
+            try: closes = download_closes(batch)
+            except CircuitOpen: break  # 被限流斷路：這輪到此為止，下一輪再抓
+            except Exception: continue
+            quotes.put_many(closes)
+            fetched += len(batch)
+            for s in batch:
+                if s in closes: self.retry_at.pop(s, None)
+                else: self.retry_at[s] = now + PREFETCH_RETRY_SECONDS
+
+        # 還沒解析過的原始代號交給 fetch_quotes_batch 試後綴，結果會寫入解析快取與報價快取
+        unresolved = [s for s, k in known.items() if not k and self.retry_at.get(s, 0) <= now]
+        if unresolved:
+            got = fetch_quotes_batch(unresolved)
+            fetched += len(unresolved)
+            for s in unresolved:
+                if s in got: self.retry_at.pop(s, None)
+                else: self.retry_at[s] = now + PREFETCH_RETRY_SECONDS
+
+        self.tracked, self.fetched, self.last_run, self.error = len(raw), fetched, time.time(), None
+        self.cycles += 1
+        return fetched
+
+@st.cache_resource
+def get_price_daemon():
+    return PriceDaemon(get_symbol_registry())
+
+def update_portfolio_data(df, category_default, quotes=None):
     df = pd.DataFrame(df)
     if df.empty: return df
     
     if "股數" in df.columns:
         df["股數"] = pd.to_numeric(df["股數"], errors='coerce').fillna(0)
-    
-    progress_text = f"正在更新 {category_default}..."
-    my_bar = st.progress(0, text=progress_text)
-    total_rows = len(df)
-    
-    for index, row in df.iterrows():
-        try:
-            ticker = str(row.get("代號", "")).strip()
-            my_bar.progress((index + 1) / total_rows, text=f"正在更新: {ticker}")
-            if not ticker or ticker.lower() == "nan": continue
-            price, valid_symbol, name = fetch_smart_ticker_data(ticker)
-            if price > 0:
-                df.at[index, "參考市價"] = price
-                if valid_symbol != ticker: df.at[index, "代號"] = valid_symbol
-                if pd.isna(row.get("名稱")) or str(row.get("名稱")).strip() == "": df.at[index, "名稱"] = name
-            if pd.isna(row.get("類別")) or str(row.get("類別")) == "":
-                df.at[index, "類別"] = category_default
-        except Exception: continue
-            
-    my_bar.empty()
+    for c in ["代號", "名稱", "類別"]:
+        if c not in df.columns: df[c] = ""
+    if "參考市價" not in df.columns: df["參考市價"] = 0.0
+    df["參考市價"] = pd.to_numeric(df["參考市價"], errors='coerce').fillna(0).astype(float)
+
+    if quotes is None:
+        symbols, need_names = portfolio_symbols(df)
+        my_bar = st.progress(0, text=f"正在更新 {category_default}...")
+        quotes = fetch_quotes_batch(symbols, need_names, progress=lambda f, t: my_bar.progress(f, text=t))
+        my_bar.empty()
+
+    tickers = df["代號"].astype(str).str.strip()
+    valid = (tickers != "") & (tickers.str.lower() != "nan") & (tickers != "None")
+    q = pd.DataFrame.from_dict(quotes, orient="index", columns=["price", "symbol", "name"]) if quotes else pd.DataFrame(columns=["price", "symbol", "name"])
+    matched = q.reindex(tickers.str.upper().values).set_axis(df.index)
+    hit = valid & (pd.to_numeric(matched["price"], errors='coerce').fillna(0) > 0)
+
+    df.loc[hit, "參考市價"] = matched.loc[hit, "price"].astype(float)
+    df.loc[hit, "代號"] = matched.loc[hit, "symbol"]
+    blank_name = df["名稱"].isna() | (df["名稱"].astype(str).str.strip() == "")
+    df.loc[hit & blank_name, "名稱"] = matched.loc[hit & blank_name, "name"]
+    blank_cat = df["類別"].isna() | (df["類別"].astype(str) == "")
+    df.loc[valid & blank_cat, "類別"] = category_default
     return df
 
-def parse_file(uploaded_file, import_type):
+# --- 本機時間序列 (SQLite) ---
+TIMESERIES_DB = os.path.join(CACHE_DIR, "timeseries.db")
+
+class TimeSeriesStore:
+    # prices：每檔有效代號的每日收盤；holdings / balances：每位使用者的每日持倉與固定資產、負債快照
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS prices (
+                    symbol TEXT NOT NULL, date TEXT NOT NULL, close REAL NOT NULL,
+                    PRIMARY KEY (symbol, date)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS holdings (
+                    user TEXT NOT NULL, date TEXT NOT NULL, symbol TEXT NOT NULL,
+                    shares REAL NOT NULL, rate REAL NOT NULL, custom_price REAL);
+                CREATE INDEX IF NOT EXISTS idx_holdings_user_date ON holdings (user, date);
+                CREATE TABLE IF NOT EXISTS balances (
+                    user TEXT NOT NULL, date TEXT NOT NULL, fixed_assets REAL NOT NULL,
+                    liabilities REAL NOT NULL, monthly_payment REAL NOT NULL,
+                    PRIMARY KEY (user, date)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS history (
+                    user TEXT NOT NULL, date TEXT NOT NULL, net_worth REAL NOT NULL,
+                    total_assets REAL NOT NULL, total_liabilities REAL NOT NULL,
+                    PRIMARY KEY (user, date)) WITHOUT ROWID;
+            """)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn: yield conn
+        finally: conn.close()
+
+    def price_date_bounds(self, symbols):
+        # 代號 -> (最早, 最晚) 收盤日期
+        if not symbols: return {}
+        with self.connect() as conn:
+            rows = conn.execute(f"SELECT symbol, MIN(date), MAX(date) FROM prices WHERE symbol IN ({','.join('?' * len(symbols))}) GROUP BY symbol",
+                                list(symbols)).fetchall()
+        return {s: (lo, hi) for s, lo, hi in rows}
+
+    def upsert_prices(self, closes):
+        # closes：index 為日期、欄位為代號的寬表
+        long = closes.stack().dropna()
+        rows = [(str(sym), str(pd.Timestamp(d).date()), float(v)) for (d, sym), v in long.items() if v > 0]
+        with self.connect() as conn:
+            conn.executemany("INSERT INTO prices VALUES (?, ?, ?) ON CONFLICT(symbol, date) DO UPDATE SET close = excluded.close", rows)
+        return len(rows)
+
+    def backfill(self, symbols, start, progress=None):
+        # 只下載缺少的日期：沒有資料的代號抓 [start, 今天]；已有資料的代號補 [start, 最早一筆) 與最後一筆 (可能是盤中價) 之後
+        symbols = sorted({str(s).strip().upper() for s in symbols if str(s).strip()})
+        bounds = self.price_date_bounds(symbols)
+        start, end = str(start), str(date.today() + timedelta(days=1))
+        groups = {}
+        for s in symbols:
+            if s not in bounds:
+                groups.setdefault((start, end), []).append(s)
+                continue
+            lo, hi = bounds[s]
+            if start < lo and np.busday_count(start, lo) > 0: groups.setdefault((start, lo), []).append(s)  # 中間只有週末時不必再抓
+            groups.setdefault((hi, end), []).append(s)
+        batches = [(rng, syms[i:i + QUOTE_BATCH_SIZE]) for rng, syms in groups.items() for i in range(0, len(syms), QUOTE_BATCH_SIZE)]
+        written = 0
+        for n, ((begin, stop), batch) in enumerate(batches, 1):
+            try:
+                data = yf_download(batch, start=begin, end=stop, interval="1d")
+                if data is not None and not data.empty:
+                    close = data["Close"]
+                    if isinstance(close, pd.Series): close = close.to_frame(batch[0])
+                    written += self.upsert_prices(close)
+            except Exception: pass
+            if progress: progress(n / len(batches), f"回補股價：批次 {n}/{len(batches)}")
+        return written
+
+    def record_snapshot(self, user, day, holdings, fixed_assets, liabilities, monthly_payment):
+        # holdings：[(代號, 股數, 匯率, 自訂價格或 None)]；同一天重複紀錄時整筆覆蓋
+        with self.connect() as conn:
+            conn.execute("DELETE FROM holdings WHERE user = ? AND date = ?", (user, day))
+            conn.executemany("INSERT INTO holdings VALUES (?, ?, ?, ?, ?, ?)", [(user, day, *h) for h in holdings])
+            conn.execute("INSERT INTO balances VALUES (?, ?, ?, ?, ?) ON CONFLICT(user, date) DO UPDATE SET "
+                         "fixed_assets = excluded.fixed_assets, liabilities = excluded.liabilities, monthly_payment = excluded.monthly_payment",
+                         (user, day, fixed_assets, liabilities, monthly_payment))
+
+    def user_symbols(self, user):
+        with self.connect() as conn:
+            return [r[0] for r in conn.execute("SELECT DISTINCT symbol FROM holdings WHERE user = ?", (user,))]
+
+    def first_snapshot(self, user):
+        with self.connect() as conn:
+            return conn.execute("SELECT MIN(date) FROM balances WHERE user = ?", (user,)).fetchone()[0]
+
+    def import_history(self, user, grid):
+        # 雲端 History 工作表 -> 本機 history；本機重建不出來的日期 (沒有快照或收盤價) 用這裡的紀錄
+        df = grid_to_frame(grid, SHEET_SCHEMA["History"])
+        day = df["Date"].map(norm_date)
+        nums = df[["Net_Worth", "Total_Assets", "Total_Liabilities"]].apply(pd.to_numeric, errors="coerce")
+        ok = day.notna() & nums.notna().all(axis=1)
+        rows = [(user, d, *map(float, v)) for d, v in zip(day[ok], nums[ok].to_numpy())]
+        with self.connect() as conn:
+            conn.executemany("INSERT INTO history VALUES (?, ?, ?, ?, ?) ON CONFLICT(user, date) DO UPDATE SET net_worth = excluded.net_worth, "
+                             "total_assets = excluded.total_assets, total_liabilities = excluded.total_liabilities", rows)
+        return len(rows)
+
+    def net_worth_series(self, user, start, end):
+        # 以本機資料重建每日淨值：每天套用當天或之前最近一次的持倉快照，收盤價只向前補值
+        # 第一次快照之前、或持倉中有代號還沒有收盤價的日期重建不出來，改用匯入的雲端 History；兩者都沒有的日期留空
+        with self.connect() as conn:
+            bal = pd.read_sql_query("SELECT date, fixed_assets, liabilities FROM balances WHERE user = ? ORDER BY date", conn, params=(user,))
+            snaps = pd.read_sql_query("SELECT date, symbol, shares, rate, custom_price FROM holdings WHERE user = ?", conn, params=(user,))
+            syms = sorted(snaps["symbol"].unique().tolist())
+            prices = pd.read_sql_query(f"SELECT symbol, date, close FROM prices WHERE date <= ? AND symbol IN ({','.join('?' * len(syms))})",
+                                       conn, params=[str(end)] + syms) if syms else pd.DataFrame(columns=["symbol", "date", "close"])
+            cloud = pd.read_sql_query("SELECT date, net_worth, total_assets, total_liabilities FROM history WHERE user = ? AND date BETWEEN ? AND ?",
+                                      conn, params=(user, str(start), str(end)))
+        cols = ["Net_Worth", "Total_Assets", "Total_Liabilities"]
+        days = pd.date_range(start, end, freq="D").strftime("%Y-%m-%d")
+        if len(days) == 0: return pd.DataFrame(columns=["Date"] + cols)
+
+        wide = prices.pivot(index="date", columns="symbol", values="close").reindex(columns=syms)
+        wide = wide.reindex(wide.index.union(days)).sort_index().ffill().reindex(days)
+        snap_dates = bal["date"].tolist()
+        which = np.searchsorted(snap_dates, days, side="right") - 1
+        assets, liab = np.full(len(days), np.nan), np.full(len(days), np.nan)
+        for k, snap_date in enumerate(snap_dates):
+            mask = which == k
+            if not mask.any(): continue
+            h = snaps[snaps["date"] == snap_date]
+            custom = h["custom_price"].fillna(0) > 0
+            market = (h.loc[~custom, "shares"] * h.loc[~custom, "rate"]).groupby(h.loc[~custom, "symbol"]).sum()
+            fixed_value = (h.loc[custom, "shares"] * h.loc[custom, "custom_price"] * h.loc[custom, "rate"]).sum()
+            assets[mask] = wide.loc[days[mask], market.index].to_numpy() @ market.to_numpy() + fixed_value + bal["fixed_assets"].iloc[k]
+            liab[mask] = bal["liabilities"].iloc[k]
+        liab[np.isnan(assets)] = np.nan
+        out = pd.DataFrame({"Net_Worth": assets - liab, "Total_Assets": assets, "Total_Liabilities": liab}, index=days)
+        out = out.fillna(cloud.set_index("date").set_axis(cols, axis=1).reindex(days))
+        return out.dropna().rename_axis("Date").reset_index()
+
+@st.cache_resource
+def get_timeseries_store():
+    return TimeSeriesStore(TIMESERIES_DB)
+
+def valuation_holdings(valuation):
+    # 從估值結果取出股票持倉 [(代號, 股數, 匯率, 自訂價格或 None)]
+    rows = []
+    for key in ["us_data", "tw_data"]:
+        df = valuation["tables"][key]
+        code = df["代號"].str.strip().str.upper()
+        keep = (code != "") & (code != "NONE") & (code != "NAN") & (df["股數"] > 0) & valuation["row_rates"][key].notna()
+        rate = valuation["row_rates"][key][keep]
+        custom = df.loc[keep, "自訂價格"].where(df.loc[keep, "自訂價格"] > 0)
+        rows += [(c, float(s), float(r), None if pd.isna(p) else float(p))
+                 for c, s, r, p in zip(code[keep], df.loc[keep, "股數"], rate, custom)]
+    return rows
+
+# --- 檔案匯入 ---
+IMPORT_CHUNK_ROWS = 100_000      # 大型 CSV 每次讀入的列數
+IMPORT_SAMPLE_BYTES = 64 * 1024  # 判斷編碼時讀取的樣本大小
+IMPORT_COLUMNS = {
+    "stock": {"ticker": ['ticker', 'symbol', '代號', '股票代號'], "shares": ['shares', 'quantity', '股數', '數量', 'qty'],
+              "price": ['price', 'cost', '自訂價格', '成本']},
+    "fixed": {"name": ['item', 'name', '資產項目', '名稱'], "value": ['value', 'amount', '現值', '金額']},
+    "liab": {"name": ['item', 'name', '負債項目', '名稱'], "amount": ['amount', '金額'], "monthly": ['monthly', 'payment', '每月扣款']},
+}
+IMPORT_REQUIRED = {"stock": (["ticker", "shares"], "CSV 缺少 [代號] 或 [股數] 欄位"),
+                   "fixed": (["name", "value"], "CSV 缺少 [資產項目] 或 [現值] 欄位"),
+                   "liab": (["name", "amount"], "CSV 缺少 [負債項目] 或 [金額] 欄位")}
+
+def detect_encoding(uploaded_file):
+    # 只讀開頭一小段判斷編碼 (utf-8 / 含 BOM / cp950)，不重讀整個檔案
+    head = uploaded_file.read(IMPORT_SAMPLE_BYTES)
+    uploaded_file.seek(0)
+    if head.startswith(codecs.BOM_UTF8): return "utf-8-sig"
     try:
-        if uploaded_file.name.endswith('.csv'): 
-            try: df = pd.read_csv(uploaded_file, encoding='utf-8')
-            except: df = pd.read_csv(uploaded_file, encoding='cp950')
-        elif uploaded_file.name.endswith(('.xls', '.xlsx')): df = pd.read_excel(uploaded_file)
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return "utf-8"
+    except UnicodeDecodeError: return "cp950"
+
+def merge_lots(df):
+    # 同代號多筆合併：股數加總，自訂價格 (成本) 以有填價格的股數加權平均
+    priced = df["自訂價格"] > 0
+    g = pd.DataFrame({"股數": df["股數"], "cost": (df["股數"] * df["自訂價格"]).where(priced, 0.0), "w": df["股數"].where(priced, 0.0)})
+    agg = g.groupby(df["代號"].values, sort=False).sum()
+    cost = (agg["cost"] / agg["w"]).where(agg["w"] > 0, 0.0)
+    return pd.DataFrame({"代號": agg.index, "股數": agg["股數"].values, "自訂價格": cost.values})
+
+def merge_into_existing(existing, new, import_type):
+    # 合併匯入：股票依代號合併 (保留原有名稱、類別、市價)，固定資產與負債直接附加
+    if import_type not in ["stock_us", "stock_tw"]:
+        return pd.concat([pd.DataFrame(existing), new], ignore_index=True)
+    both = pd.concat([prepare_table(existing, STOCK_COLS)[STOCK_COLS], new[STOCK_COLS]], ignore_index=True)
+    both["代號"] = both["代號"].str.strip().str.upper()
+    both = both[(both["代號"] != "") & (both["代號"] != "NAN")]
+    info = both.groupby("代號", sort=False)[["名稱", "類別", "參考市價"]].first()
+    return merge_lots(both).join(info, on="代號")[STOCK_COLS]
+
+def parse_file(uploaded_file, import_type, encoding=None):
+    try:
+        started = time.perf_counter()
+        if uploaded_file.name.endswith('.csv'):
+            enc = encoding or detect_encoding(uploaded_file)
+            header = pd.read_csv(uploaded_file, encoding=enc, nrows=0).columns
+            uploaded_file.seek(0)
+        elif uploaded_file.name.endswith(('.xls', '.xlsx')):
+            df_x = pd.read_excel(uploaded_file)
+            header = df_x.columns
         else: return None, "格式不支援"
 
-        df.columns = [str(c).lower().strip() for c in df.columns]
-        new_data = []
-        
-        if import_type in ["stock_us", "stock_tw"]:
-            ticker_col = next((c for c in df.columns if c in ['ticker', 'symbol', '代號', '股票代號']), None)
-            shares_col = next((c for c in df.columns if c in ['shares', 'quantity', '股數', '數量', 'qty']), None)
-            price_col = next((c for c in df.columns if c in ['price', 'cost', '自訂價格', '成本']), None)
-            
-            if not ticker_col or not shares_col: return None, "CSV 缺少 [代號] 或 [股數] 欄位"
-            
-            df[ticker_col] = df[ticker_col].astype(str).str.strip().str.upper()
-            df[shares_col] = pd.to_numeric(df[shares_col], errors='coerce').fillna(0)
-            
-            for _, row in df.iterrows():
-                new_data.append({
-                    "代號": row[ticker_col], "名稱": "", 
-                    "股數": float(row[shares_col]),
-                    "類別": "美股" if import_type == "stock_us" else "台股",
-                    "自訂價格": float(row[price_col]) if price_col else 0.0, "參考市價": 0.0
-                })
-
-        elif import_type == "fixed":
-            name_col = next((c for c in df.columns if c in ['item', 'name', '資產項目', '名稱']), None)
-            val_col = next((c for c in df.columns if c in ['value', 'amount', '現值', '金額']), None)
-            if not name_col or not val_col: return None, "CSV 缺少 [資產項目] 或 [現值] 欄位"
-            for _, row in df.iterrows():
-                new_data.append({
-                    "資產項目": str(row[name_col]), 
-                    "現值": float(pd.to_numeric(row[val_col], errors='coerce') or 0), 
-                    "類別": "固定資產"
-                })
-
-        elif import_type == "liab":
-            name_col = next((c for c in df.columns if c in ['item', 'name', '負債項目', '名稱']), None)
-            amount_col = next((c for c in df.columns if c in ['amount', '金額']), None)
-            monthly_col = next((c for c in df.columns if c in ['monthly', 'payment', '每月扣款']), None)
-            if not name_col or not amount_col: return None, "CSV 缺少 [負債項目] 或 [金額] 欄位"
-            for _, row in df.iterrows():
-                m_val = float(pd.to_numeric(row[monthly_col], errors='coerce') or 0) if monthly_col else 0.0
-                new_data.append({
-                    "負債項目": str(row[name_col]), 
-                    "金額": float(pd.to_numeric(row[amount_col], errors='coerce') or 0), 
-                    "每月扣款": m_val
-                })
-
-        return pd.DataFrame(new_data), None
+        kind = "stock" if import_type in ["stock_us", "stock_tw"] else import_type
+        norm = {c: str(c).lower().strip() for c in header}
+        found = {k: next((c for c in header if norm[c] in names), None) for k, names in IMPORT_COLUMNS[kind].items()}
+        required, msg = IMPORT_REQUIRED[kind]
+        if not all(found[k] for k in required): return None, msg
+
+        # 只讀需要的欄位；CSV 以固定列數分批讀入，每批整欄轉換
+        use = [c for c in found.values() if c is not None]
+        if uploaded_file.name.endswith('.csv'):
+            chunks = pd.read_csv(uploaded_file, encoding=enc, usecols=use, dtype=str, chunksize=IMPORT_CHUNK_ROWS)
+        else: chunks = [df_x[use]]
+        num = lambda chunk, k: pd.to_numeric(chunk[found[k]], errors='coerce').fillna(0).astype(float) if found.get(k) else 0.0
+
+        parts, n_rows = [], 0
+        for chunk in chunks:
+            n_rows += len(chunk)
+            if kind == "stock":
+                parts.append(pd.DataFrame({"代號": chunk[found["ticker"]].astype(str).str.strip().str.upper(),
+                                           "股數": num(chunk, "shares"), "自訂價格": num(chunk, "price")}))
+            elif kind == "fixed":
+                parts.append(pd.DataFrame({"資產項目": chunk[found["name"]].astype(str), "現值": num(chunk, "value"), "類別": "固定資產"}))
+            else:
+                parts.append(pd.DataFrame({"負債項目": chunk[found["name"]].astype(str), "金額": num(chunk, "amount"), "每月扣款": num(chunk, "monthly")}))
+
+        new_data = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+        if kind == "stock":
+            new_data = new_data[(new_data["代號"] != "") & (new_data["代號"] != "NAN")] if not new_data.empty else pd.DataFrame(columns=["代號", "股數", "自訂價格"])
+            new_data = merge_lots(new_data)
+            new_data["名稱"] = ""
+            new_data["類別"] = "美股" if import_type == "stock_us" else "台股"
+            new_data["參考市價"] = 0.0
+            new_data = new_data[STOCK_COLS]
+
+        seconds = time.perf_counter() - started
+        new_data.attrs["import_stats"] = {"rows": n_rows, "records": len(new_data), "seconds": seconds,
+                                          "rows_per_sec": n_rows / seconds if seconds > 0 else float(n_rows)}
+        return new_data, None
+    except UnicodeDecodeError as e:
+        # 開頭樣本是純 ASCII、後段才出現 Big5 文字：整份改用 cp950 重讀一次
+        if encoding is None and uploaded_file.name.endswith('.csv'):
+            uploaded_file.seek(0)
+            return parse_file(uploaded_file, import_type, "cp950")
+        return None, f"解析失敗: {str(e)}"
     except Exception as e: return None, f"解析失敗: {str(e)}"
 
+# --- 匯率 (依有效代號推斷幣別，批次取得並快取) ---
+BASE_CURRENCY = "TWD"
+FX_TTL_SECONDS = float(os.environ.get("NEXUS_FX_TTL", 3600))  # 匯率快取時間 (秒)
+FX_RETRY_SECONDS = 300                                         # 下載失敗後多久再試
+SUFFIX_CURRENCY = {".TW": "TWD", ".TWO": "TWD", ".T": "JPY", ".HK": "HKD", ".SS": "CNY", ".SZ": "CNY", ".KS": "KRW",
+                   ".L": "GBp", ".DE": "EUR", ".PA": "EUR", ".AS": "EUR", ".TO": "CAD", ".AX": "AUD", ".SI": "SGD"}
+FX_SUBUNITS = {"GBp": ("GBP", 0.01)}  # 以輔幣報價的市場 (倫敦以便士計價)
+
+def symbol_currencies(codes, default="USD"):
+    # 整欄推斷幣別：原始代號先經代號快取換成有效代號，再看 -USD 之類的幣對或 .TW 之類的交易所後綴
+    codes = pd.Series(codes, dtype=object).astype(str).str.strip().str.upper()
+    cache = get_resolution_cache()
+    resolved = {c: (cache.get(c) or (c, ""))[0] for c in codes.unique()}
+    sym = codes.map(resolved).astype(str)
+    pair = sym.str.extract(r"-([A-Z]{3})$")[0]
+    suffix = sym.str.extract(r"(\.[A-Z]+)$")[0].map(SUFFIX_CURRENCY)
+    return pair.fillna(suffix).fillna(default).astype(object)
+
+class FxRates:
+    # 幣別 -> (對 TWD 匯率, 取得時間)；缺少或過期的幣別合併成一次下載
+    def __init__(self, ttl=FX_TTL_SECONDS):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def rates(self, currencies):
+        # 回傳 pd.Series(幣別 -> 匯率)；下載失敗時沿用舊值，沒有舊值時 USD 用 EXCHANGE_RATE、其他幣別為 NaN
+        now = time.time()
+        bases = {FX_SUBUNITS.get(c, (c, 1.0))[0] for c in currencies} - {BASE_CURRENCY}
+        with self.lock:
+            todo = sorted(c for c in bases if c not in self.entries or now - self.entries[c][1] > self.ttl)
+        if todo:
+            try: got = download_closes([f"{c}{BASE_CURRENCY}=X" for c in todo])
+            except Exception: got = {}
+            with self.lock:
+                for c in todo:
+                    price = got.get(f"{c}{BASE_CURRENCY}=X")
+                    if price: self.entries[c] = (price, now)
+                    else: self.entries[c] = (self.entries.get(c, (None, 0))[0], now - self.ttl + FX_RETRY_SECONDS)
+        with self.lock: table = {c: self.entries[c][0] for c in bases if self.entries.get(c, (None,))[0]}
+        table[BASE_CURRENCY] = 1.0
+        out = {}
+        for c in currencies:
+            base, factor = FX_SUBUNITS.get(c, (c, 1.0))
+            out[c] = table.get(base, EXCHANGE_RATE if base == "USD" else np.nan) * factor
+        return pd.Series(out, dtype=float)
+
+@st.cache_resource
+def get_fx_rates():
+    return FxRates()
+
+# --- 估值引擎 (整欄運算) ---
+STOCK_COLS = ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"]
+FIXED_COLS = ["資產項目", "現值", "類別"]
+LIAB_COLS = ["負債項目", "金額", "每月扣款"]
+NUM_COLS = ["股數", "現值", "金額", "自訂價格", "參考市價", "每月扣款"]
+
+def prepare_table(data, cols):
+    # 補齊欄位並統一型別：數值欄轉 float，其餘轉字串
+    df = pd.DataFrame(data)
+    if df.empty: df = pd.DataFrame(columns=cols)
+    for c in cols:
+        if c not in df.columns: df[c] = 0.0 if c in NUM_COLS else ""
+    for c in df.columns:
+        if c in NUM_COLS: df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0).astype(float)
+        else: df[c] = df[c].astype(str).replace("nan", "")
+    return df
+
+def table_values(df, rate=1.0):
+    # 股票：自訂價格優先，否則用參考市價；固定資產用現值；負債用金額
+    if "股數" in df.columns:
+        price = df["自訂價格"].where(df["自訂價格"] > 0, df["參考市價"])
+        return price * df["股數"] * rate
+    if "現值" in df.columns: return df["現值"].copy()
+    if "金額" in df.columns: return df["金額"].copy()
+    return pd.Series(0.0, index=df.index)
+
+VALUATION_SPECS = {  # 資料鍵 -> (欄位, 未加後綴代號的預設幣別)
+    "us_data": (STOCK_COLS, "USD"),
+    "tw_data": (STOCK_COLS, "TWD"),
+    "fixed_data": (FIXED_COLS, BASE_CURRENCY),
+    "liab_data": (LIAB_COLS, BASE_CURRENCY),
+}
+ASSET_SPECS = {"us_data": ("代號", "美股"), "tw_data": ("代號", "台股"), "fixed_data": ("資產項目", "固定")}  # 資料鍵 -> (名稱欄, 預設類別)
+
+SUM_COLS = {"fixed_data": ["現值"], "liab_data": ["金額", "每月扣款"]}  # 估值結果要用到的欄位總和，編輯時增量更新
+
+def coerce_cell(col, v):
+    # data_editor 回報的儲存格值轉成與 prepare_table 相同的型別
+    if col in NUM_COLS:
+        v = pd.to_numeric(v, errors='coerce')
+        return 0.0 if pd.isna(v) else float(v)
+    v = "" if v is None else str(v)
+    return "" if v == "nan" else v
+
+def asset_rows(key, df, vals):
+    # 計入資產的列 (名稱非空且價值 > 0) 與每列類別 (空白用預設類別)
+    name_col, default_cat = ASSET_SPECS[key]
+    name = df[name_col].str.strip()
+    keep = (name != "") & (name != "None") & (name != "nan") & (vals > 0)
+    return keep, name, df["類別"].replace("", default_cat)
+
+class PortfolioModel:
+    # 一個 session 的投資組合：每張表保留一份型別整理好的 DataFrame，以及每列幣別、匯率、TWD 價值與類別小計
+    # session 的表格就是這裡的 DataFrame；data_editor 回報的逐列變動只重算被改到的列，總額與淨資產跟著增減
+    # 匯入、更新股價等整份替換的表格 (物件不同) 在下次取用時重建
+    def __init__(self, fx=None):
+        self.fx = fx
+        self.entries = {}
+        self.gen = 0  # 每次重建表格就加一；data_editor 的 key 帶著它，重建後的表格是新的 widget，不會沿用舊的 edited_rows
+
+    def rates(self, currencies):
+        return (self.fx or get_fx_rates()).rates(sorted(set(currencies) | {BASE_CURRENCY}))
+
+    def entry(self, key, data):
+        # 整理好的表格與每列幣別；同一個 DataFrame 物件直接沿用
+        entry = self.entries.get(key)
+        if entry is not None and entry["df"] is data: return entry
+        cols, default_cur = VALUATION_SPECS[key]
+        df = prepare_table(data, cols)
+        currencies = symbol_currencies(df["代號"], default_cur) if cols is STOCK_COLS else pd.Series(default_cur, index=df.index, dtype=object)
+        self.gen += 1
+        entry = self.entries[key] = {"df": df, "currencies": currencies, "cur_set": set(currencies), "fx": None, "gen": self.gen}
+        return entry
+
+    def table(self, key, data, fx_table=None):
+        # 單表估值；這張表用到的匯率沒變時不重算
+        entry = self.entry(key, data)
+        if fx_table is None: fx_table = self.rates(entry["cur_set"])
+        fx_used = fx_table.reindex(sorted(entry["cur_set"]))
+        if entry["fx"] is None or not entry["fx"].equals(fx_used): self.revalue(key, entry, fx_used)
+        return entry
+
+    def revalue(self, key, entry, fx_used):
+        # 整張表重算每列價值、總和與類別小計 (重建或匯率變動時)
+        df = entry["df"]
+        entry["fx"] = fx_used
+        entry["rate"] = entry["currencies"].map(fx_used).astype(float)
+        entry["vals"] = table_values(df) * entry["rate"]
+        entry["total"] = float(entry["vals"].sum())
+        entry["sums"] = {c: float(df[c].sum()) for c in SUM_COLS.get(key, [])}
+        if key in ASSET_SPECS:
+            keep, _, cat = asset_rows(key, df, entry["vals"])
+            g = entry["vals"][keep].groupby(cat[keep])
+            entry["cats"] = {c: [float(v), int(n)] for (c, v), n in zip(g.sum().items(), g.size())}
+
+    def add_cats(self, key, entry, rows, sign):
+        # 把指定列的價值加入 (sign=1) 或移出 (sign=-1) 類別小計
+        vals = entry["vals"].iloc[rows]
+        keep, _, cat = asset_rows(key, entry["df"].iloc[rows], vals)
+        cats = entry["cats"]
+        for c, v in zip(cat[keep], vals[keep]):
+            s = cats.setdefault(c, [0.0, 0])
+            s[0] += sign * float(v)
+            s[1] += sign
+            if s[1] <= 0: del cats[c]
+
+    def apply_edits(self, key, edited_rows):
+        # 套用 data_editor 的 edited_rows ({列位置: {欄位: 值}})，只重算值真的變動的列；回傳變動的儲存格數
+        entry = self.entries[key]
+        df = entry["df"]
+        changes = {}
+        for pos, cells in edited_rows.items():
+            pos = int(pos)
+            if pos >= len(df): continue
+            for col, v in cells.items():
+                if col not in df.columns: continue
+                v = coerce_cell(col, v)
+                if df[col].iat[pos] != v: changes[(pos, col)] = v
+        if not changes: return 0
+
+        rows = sorted({pos for pos, _ in changes})
+        old_vals = float(entry["vals"].iloc[rows].sum())
+        old_sums = {c: float(df[c].iloc[rows].sum()) for c in entry["sums"]}
+        if key in ASSET_SPECS: self.add_cats(key, entry, rows, -1)
+        for (pos, col), v in changes.items(): df.iat[pos, df.columns.get_loc(col)] = v
+
+        sub = df.iloc[rows]
+        if any(col == "代號" for _, col in changes) and "代號" in VALUATION_SPECS[key][0]:
+            cur = symbol_currencies(sub["代號"], VALUATION_SPECS[key][1])
+            entry["currencies"].iloc[rows] = cur.to_numpy()
+            if not set(cur) <= entry["cur_set"]:
+                # 出現新幣別：補抓匯率並整張重算
+                entry["cur_set"] |= set(cur)
+                entry["fx"] = None
+                self.table(key, df)
+                return len(changes)
+        rate = entry["currencies"].iloc[rows].map(entry["fx"]).astype(float)
+        vals = table_values(sub) * rate
+        entry["rate"].iloc[rows] = rate.to_numpy()
+        entry["vals"].iloc[rows] = vals.to_numpy()
+        entry["total"] += float(vals.sum()) - old_vals
+        for c in entry["sums"]: entry["sums"][c] += float(sub[c].sum()) - old_sums[c]
+        if key in ASSET_SPECS: self.add_cats(key, entry, rows, 1)
+        return len(changes)
+
+    def refresh(self, data):
+        # data: {資料鍵: 表格}；四張表共用一次匯率查詢
+        entries = {key: self.entry(key, d) for key, d in data.items()}
+        fx_table = self.rates(set().union(*(e["cur_set"] for e in entries.values())))
+        for key, d in data.items(): self.table(key, d, fx_table)
+        return fx_table
+
+    def summary(self, data=None):
+        # 總資產、類別總額與權重、負債與淨資產：只由各表的小計相加，不掃描每一列
+        if data is not None: self.refresh(data)
+        cats = {}
+        for key in ASSET_SPECS:
+            for c, (v, _) in self.entries[key]["cats"].items(): cats[c] = cats.get(c, 0.0) + v
+        category_totals = pd.Series(cats, dtype=float).sort_index()
+        total_assets = float(category_totals.sum())
+        liab = self.entries["liab_data"]["sums"]
+        return {
+            "category_totals": category_totals,
+            "category_weights": category_totals / total_assets if total_assets > 0 else category_totals * 0,
+            "total_assets": total_assets,
+            "total_liab": liab["金額"],
+            "total_monthly": liab["每月扣款"],
+            "net_worth": total_assets - liab["金額"],
+            "house_value": self.entries["fixed_data"]["sums"]["現值"],
+        }
+
+    def assets(self, key):
+        entry = self.entries[key]
+        keep, name, cat = asset_rows(key, entry["df"], entry["vals"])
+        return pd.DataFrame({"資產": name[keep], "類別": cat[keep], "價值": entry["vals"][keep]})
+
+    def valuation(self, data):
+        # 完整估值結果 (含每列資產清單)，給 FIRE、圖表與快照使用
+        fx_table = self.refresh(data)
+        out = self.summary()
+        entries = {key: self.entries[key] for key in data}
+        out.update({
+            "tables": {key: e["df"] for key, e in entries.items()},
+            "table_totals": {key: e["total"] for key, e in entries.items()},
+            "row_values": {key: e["vals"] for key, e in entries.items()},
+            "row_rates": {key: e["rate"] for key, e in entries.items()},
+            "row_currencies": {key: e["currencies"] for key, e in entries.items()},
+            "fx_table": fx_table,
+            "missing_fx": [c for c, r in fx_table.items() if pd.isna(r)],
+            "assets": pd.concat([self.assets(key) for key in ASSET_SPECS], ignore_index=True),
+        })
+        return out
+
+def compute_valuation(us_data, tw_data, fixed_data, liab_data, fx=None, model=None):
+    # 一次算出四張表的每列價值 (TWD)、類別總額與權重、淨資產
+    # 股票列依代號推斷幣別，再與匯率表整欄對應；未加後綴的代號美股視為 USD、台股視為 TWD
+    # model (可選)：跨 rerun 保留的 PortfolioModel，只有資料或匯率變動的表才重算
+    return (model or PortfolioModel(fx)).valuation({"us_data": us_data, "tw_data": tw_data, "fixed_data": fixed_data, "liab_data": liab_data})
+
 # --- 【修正】FIRE 曲線計算修正 ---
-@st.cache_data
+FIRE_LEVELS = {"Lean": 600000, "Barista": 800000, "Regular": 1000000, "Fat": 2500000}  # 各等級年支出，目標 = 年支出 x 25
+
+FIRE_END_AGE = 65  # 模擬到幾歲
+
+def fire_ages(current_age):
+    # 目前年齡到 FIRE_END_AGE；已超過時至少保留目前這一年 (曲線只有起點)，避免空陣列
+    return np.arange(current_age, max(FIRE_END_AGE, current_age) + 1)
+
+@st.cache_data(max_entries=32)
 def calculate_fire_curves_advanced(current_age, liquid_assets, house_value, total_debt, savings, invest_return, house_growth, inflation, custom_expense, include_house_growth):
-    ages = list(range(current_age, 66))
+    ages = fire_ages(current_age).tolist()
     
     # 初始狀態
     curr_liquid = liquid_assets  # 只有流動資產會參與複利
     curr_house = house_value
     wealth_curve = [curr_liquid + curr_house - total_debt] # 淨資產起始點
     
-    levels = {"Lean": 600000, "Barista": 800000, "Regular": 1000000, "Fat": 2500000}
-    level_curves = {k: [v * 25] for k, v in levels.items()}
+    level_curves = {k: [v * 25] for k, v in FIRE_LEVELS.items()}
     custom_target = [custom_expense * 25]
-    curr_levels = {k: v * 25 for k, v in levels.items()}
+    curr_levels = {k: v * 25 for k, v in FIRE_LEVELS.items()}
     curr_custom = custom_expense * 25
     
     for _ in range(len(ages) - 1):
@@ -401,6 +2184,74 @@ def calculate_fire_curves_advanced(current_age, liquid_assets, house_value, tota
             
     return ages, wealth_curve, level_curves, custom_target
 
+# --- FIRE 敏感度網格 ---
+# 與 FIRE 分頁的兩個滑桿相同的範圍與刻度
+FIRE_RETURN_GRID = np.round(np.arange(0.0, 20.0 + 1e-9, 0.1), 1)
+FIRE_INFLATION_GRID = np.round(np.arange(0.0, 10.0 + 1e-9, 0.1), 1)
+
+@st.cache_data(max_entries=16)
+def calculate_fire_grid(current_age, liquid_assets, house_value, total_debt, savings, house_growth, custom_expense, include_house_growth):
+    # 一次算出所有 報酬率 x 通膨 組合的資產曲線、FIRE 目標曲線與達標年數
+    ages = fire_ages(current_age)
+    rate = FIRE_RETURN_GRID[:, None] / 100
+    liquid = np.empty((len(FIRE_RETURN_GRID), len(ages)))
+    liquid[:, 0] = liquid_assets
+    for t in range(1, len(ages)):
+        liquid[:, t] = (liquid[:, t - 1] + savings) * (1 + rate[:, 0])
+    house = np.full(len(ages), float(house_value))
+    if include_house_growth and house_value > 0: house = house_value * (1 + house_growth / 100) ** np.arange(len(ages))
+    wealth = liquid + house - total_debt                                                     # (報酬率, 年)
+    targets = custom_expense * 25 * (1 + FIRE_INFLATION_GRID[:, None] / 100) ** np.arange(len(ages))  # (通膨, 年)
+
+    reached = wealth[None, :, :] >= targets[:, None, :]                                      # (通膨, 報酬率, 年)
+    years_to_fire = np.where(reached.any(axis=2), reached.argmax(axis=2), np.nan)
+    return {"ages": ages.tolist(), "wealth": wealth, "targets": targets, "years_to_fire": years_to_fire}
+
+def fire_grid_index(grid, value):
+    # 滑桿數值在網格上的位置；不在刻度上 (例如 AI 預測值) 時回傳 None
+    idx = int(round(value * 10))
+    if 0 <= idx < len(grid) and abs(grid[idx] - value) < 1e-9: return idx
+    return None
+
+# --- FIRE 蒙地卡羅模擬 ---
+MC_PATH_OPTIONS = [10_000, 20_000, 50_000, 100_000]
+
+@st.cache_data(max_entries=64)
+def simulate_fire_monte_carlo(current_age, liquid_assets, house_value, total_debt, savings, invest_return, return_vol,
+                              house_growth, inflation, inflation_vol, custom_expense, include_house_growth, n_paths=20_000, seed=42):
+    # 以常態分佈抽樣每年報酬率與通膨，一次算出 n_paths 條路徑；陣列為 (年, 路徑)，逐年運算時記憶體連續
+    ages = fire_ages(current_age)
+    years = len(ages) - 1
+    rng = np.random.default_rng(seed)
+    f32 = np.float32
+    r = (rng.standard_normal((years, n_paths), dtype=f32) * f32(return_vol / 100) + f32(invest_return / 100)).clip(-0.95, None)
+    inf = (rng.standard_normal((years, n_paths), dtype=f32) * f32(inflation_vol / 100) + f32(inflation / 100)).clip(-0.5, None)
+
+    # L_t = (L_{t-1} + 年投入) * (1 + r_t)  =>  L_t = G_t * (L_0 + 年投入 * sum_{k<=t} 1 / G_{k-1})，G 為報酬累乘
+    growth = np.cumprod(1 + r, axis=0)
+    prev = np.concatenate([np.ones((1, n_paths), f32), growth[:-1]])
+    liquid = growth * (f32(liquid_assets) + f32(savings) * np.cumsum(1 / prev, axis=0))
+    liquid = np.concatenate([np.full((1, n_paths), liquid_assets, f32), liquid])
+
+    house = np.full(years + 1, float(house_value))
+    if include_house_growth and house_value > 0: house = house_value * (1 + house_growth / 100) ** np.arange(years + 1)
+    wealth = liquid + (house - total_debt).astype(f32)[:, None]
+
+    price_level = np.concatenate([np.ones((1, n_paths), f32), np.cumprod(1 + inf, axis=0)])
+    def reach_prob(annual_expense):
+        # 各年齡「之前任一年已達標」的路徑比例
+        reached = wealth >= price_level * f32(annual_expense * 25)
+        return np.logical_or.accumulate(reached, axis=0).mean(axis=1)
+
+    p10, p50, p90 = np.percentile(wealth, [10, 50, 90], axis=1)
+    return {
+        "ages": ages.tolist(),
+        "p10": p10.tolist(), "p50": p50.tolist(), "p90": p90.tolist(),
+        "level_probs": {k: reach_prob(v).tolist() for k, v in FIRE_LEVELS.items()},
+        "custom_prob": reach_prob(custom_expense).tolist(),
+        "n_paths": n_paths,
+    }
+
 def predict_portfolio_return_detail(df_assets, include_house):
     if df_assets.empty: return 5.0, "無資產"
     returns_map = {"美股": 10.0, "台股": 8.0, "虛擬貨幣": 25.0, "現金": 1.0, "房產": 3.0, "固定資產": 3.0}
@@ -444,152 +2295,173 @@ def main_app():
     with st.sidebar:
         st.info(f"👤 User: **{st.session_state.current_user}**")
         auto_sync = st.toggle("☁️ 自動同步 (Auto-Sync)", value=False)
+        sync_status_panel(st.session_state.target_sheet)
         st.divider()
         if st.button("☁️ **手動同步存檔**", type="primary"): save_data_to_cloud(st.session_state.target_sheet)
         st.divider()
+        if st.button("🧹 重設代號快取", help="清除代號解析快取，下次更新股價時重新判斷 .TW / .TWO / -USD"):
+            get_resolution_cache().invalidate()
+            st.toast("代號快取已清除")
         if st.button("🚪 登出系統"):
+            get_symbol_registry().drop(st.session_state.get("session_token"))
             st.session_state.clear()
             st.rerun()
+        if st.toggle("🩺 效能診斷", value=False): perf_panel()
 
     def fmt_money(val): return "****" if privacy_mode else f"${val:,.0f}"
     
     privacy_mode = False
 
     if not st.session_state.get('data_loaded'):
-        with st.spinner("正在從雲端載入您的資產數據..."):
+        with st.spinner("正在從雲端載入您的資產數據..."), timed("stage.load"):
             load_data_from_cloud(st.session_state.target_sheet)
 
+    if st.session_state.get('load_stats'):
+        ls = st.session_state.load_stats
+        if get_storage().name == "sheets": st.sidebar.caption(f"☁️ 雲端載入：{ls['requests']} 次請求 · {ls['seconds']:.2f} 秒")
+        else: st.sidebar.caption(f"💾 本機載入 ({get_storage().name})：{ls['seconds'] * 1000:.0f} ms")
+
     st.title(f"🌌 NEXUS: {st.session_state.current_user}'s Command")
     if 'fire_states' not in st.session_state: st.session_state.fire_states = {"Lean": True, "Barista": True, "Regular": True, "Fat": True}
     
-    def ensure_cols(df, cols):
-        if df.empty: return pd.DataFrame(columns=cols)
-        for c in cols:
-            if c not in df.columns:
-                df[c] = 0 if c in ["金額", "每月扣款", "現值", "股數"] else ""
-        return df
-
-    df_us = ensure_cols(pd.DataFrame(st.session_state.us_data), ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"])
-    df_tw = ensure_cols(pd.DataFrame(st.session_state.tw_data), ["代號", "名稱", "股數", "類別", "自訂價格", "參考市價"])
-    df_fixed = ensure_cols(pd.DataFrame(st.session_state.fixed_data), ["資產項目", "現值", "類別"])
-    df_liab = ensure_cols(pd.DataFrame(st.session_state.liab_data), ["負債項目", "金額", "每月扣款"])
-
-    assets_list = []
-    if not df_us.empty:
-        for _, row in df_us.iterrows():
-            p = float(row.get("自訂價格", 0) or 0)
-            if p <= 0: p = float(row.get("參考市價", 0) or 0)
-            v = p * float(row.get("股數", 0) or 0) * EXCHANGE_RATE
-            code = str(row.get("代號", "")).strip()
-            if code and code != "None" and v > 0:
-                disp_name = code
-                assets_list.append({"資產": disp_name, "類別": row.get("類別","美股"), "價值": v})
-    
-    if not df_tw.empty:
-        for _, row in df_tw.iterrows():
-            p = float(row.get("自訂價格", 0) or 0)
-            if p <= 0: p = float(row.get("參考市價", 0) or 0)
-            v = p * float(row.get("股數", 0) or 0)
-            code = str(row.get("代號", "")).strip()
-            if code and code != "None" and v > 0:
-                disp_name = code
-                assets_list.append({"資產": disp_name, "類別": row.get("類別","台股"), "價值": v})
-    
-    if not df_fixed.empty:
-        for _, row in df_fixed.iterrows():
-            name = str(row.get("資產項目", "")).strip()
-            v = float(row.get("現值", 0) or 0)
-            if name and name != "None" and v > 0:
-                assets_list.append({"資產": name, "類別": row.get("類別","固定"), "價值": v})
-
-    df_assets = pd.DataFrame(assets_list)
-    if df_assets.empty:
-        df_assets = pd.DataFrame(columns=["資產", "類別", "價值"])
-        total_assets = 0
-    else:
-        total_assets = df_assets["價值"].sum()
-    
-    total_liab = pd.to_numeric(df_liab["金額"], errors='coerce').fillna(0).sum() if not df_liab.empty else 0
-    total_monthly = pd.to_numeric(df_liab["每月扣款"], errors='coerce').fillna(0).sum() if not df_liab.empty else 0
-    
-    net_worth = total_assets - total_liab
+    # 投資組合模型跨 rerun 保留在 session：session 的四張表換成模型內的 DataFrame，表格編輯只增量更新
+    model = st.session_state.setdefault("portfolio_model", PortfolioModel())
+    def session_tables():
+        for key in VALUATION_SPECS: st.session_state[key] = model.entry(key, st.session_state[key])["df"]
+        return {key: st.session_state[key] for key in VALUATION_SPECS}
+    def current_valuation():
+        return model.valuation(session_tables())
+    with timed("stage.valuation"):
+        valuation = current_valuation()
+    df_assets = valuation["assets"]
+    total_assets = valuation["total_assets"]
+    total_liab = valuation["total_liab"]
+    total_monthly = valuation["total_monthly"]
+    net_worth = valuation["net_worth"]
+    if valuation["missing_fx"]:
+        st.warning(f"⚠️ 取不到 {', '.join(valuation['missing_fx'])} 對 TWD 的匯率，這些持倉暫不計入總額，請稍後再更新")
+
+    # 登記這個 session 持有的代號，背景預抓會在開盤時段持續更新它們的報價；fragment 內的互動也要續約，否則 30 分鐘後過期
+    def register_symbols():
+        if not PREFETCH_ENABLED: return
+        token = st.session_state.setdefault("session_token", secrets.token_hex(8))
+        get_symbol_registry().update(token, portfolio_symbols(st.session_state.us_data)[0] + portfolio_symbols(st.session_state.tw_data)[0])
+        get_price_daemon().ensure_started()
 
-    save_daily_record_cloud(st.session_state.target_sheet, net_worth, total_assets, total_liab, total_monthly)
+    def keep_alive():
+        if PREFETCH_ENABLED: get_symbol_registry().touch(st.session_state.get("session_token"))
+    register_symbols()
 
-    c1, c2, c3, c4 = st.columns(4)
-    with c1: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">💰 淨資產 (Net Worth)</div><div class="nexus-value">{fmt_money(net_worth)}</div></div>""", unsafe_allow_html=True)
-    with c2: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">🏦 總資產 (Total Assets)</div><div class="nexus-value">{fmt_money(total_assets)}</div></div>""", unsafe_allow_html=True)
-    with c3: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">💳 總負債 (Liabilities)</div><div class="nexus-value-red">{fmt_money(total_liab)}</div></div>""", unsafe_allow_html=True)
-    with c4: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">💸 月支出 (Burn Rate)</div><div class="nexus-value-orange">{fmt_money(total_monthly)}</div></div>""", unsafe_allow_html=True)
+    with timed("stage.daily_record"):
+        save_daily_record_cloud(st.session_state.target_sheet, net_worth, total_assets, total_liab, total_monthly)
+    if st.session_state.get("local_snapshot_date") != str(date.today()):
+        try:
+            get_timeseries_store().record_snapshot(st.session_state.target_sheet, str(date.today()), valuation_holdings(valuation),
+                                                   valuation["house_value"], total_liab, total_monthly)
+            st.session_state.local_snapshot_date = str(date.today())
+        except Exception: pass
+
+    # 總覽卡片是具名的 fragment：表格編輯改變總覽時，只 rerun 卡片與那張表，不用定時器也不整頁 rerun
+    @st.fragment(key="summary_cards")
+    @metered("fragment.cards")
+    def show_cards():
+        v = model.summary(session_tables())
+        with st.container():
+            c1, c2, c3, c4 = st.columns(4)
+            with c1: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">💰 淨資產 (Net Worth)</div><div class="nexus-value">{fmt_money(v["net_worth"])}</div></div>""", unsafe_allow_html=True)
+            with c2: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">🏦 總資產 (Total Assets)</div><div class="nexus-value">{fmt_money(v["total_assets"])}</div></div>""", unsafe_allow_html=True)
+            with c3: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">💳 總負債 (Liabilities)</div><div class="nexus-value-red">{fmt_money(v["total_liab"])}</div></div>""", unsafe_allow_html=True)
+            with c4: st.markdown(f"""<div class="nexus-card"><div class="nexus-label">💸 月支出 (Burn Rate)</div><div class="nexus-value-orange">{fmt_money(v["total_monthly"])}</div></div>""", unsafe_allow_html=True)
+    show_cards()
 
     st.divider()
-    tab_edit, tab_fire, tab_vis, tab_hist = st.tabs(["📝 **Asset Editor**", "🔥 **FIRE Analytics**", "📊 **Visuals**", "📈 **History**"])
+    # 只執行目前選取的分頁；切換分頁時整頁 rerun，分頁內的互動只 rerun 各自的 fragment
+    tab_edit, tab_fire, tab_vis, tab_hist = st.tabs(["📝 **Asset Editor**", "🔥 **FIRE Analytics**", "📊 **Visuals**", "📈 **History**"],
+                                                    on_change="rerun", key="main_tabs")
 
-    with tab_edit:
+    @timed("stage.editor")
+    def editor_panel():
         c_btn, _ = st.columns([1, 4])
         with c_btn:
             if st.button("⚡ **UPDATE PRICES (更新股價)**", type="primary", help="更新價格並自動存檔"):
-                st.session_state.us_data = update_portfolio_data(st.session_state.us_data, "美股").to_dict('records')
-                st.session_state.tw_data = update_portfolio_data(st.session_state.tw_data, "台股").to_dict('records')
+                # 美股與台股的代號合併成一次批次查詢，進度以批次為單位回報
+                us_syms, us_names = portfolio_symbols(st.session_state.us_data)
+                tw_syms, tw_names = portfolio_symbols(st.session_state.tw_data)
+                my_bar = st.progress(0, text="正在更新股價...")
+                quotes = fetch_quotes_batch(us_syms + tw_syms, us_names + tw_names, progress=lambda f, t: my_bar.progress(f, text=t))
+                my_bar.empty()
+                st.session_state.us_data = update_portfolio_data(st.session_state.us_data, "美股", quotes).to_dict('records')
+                st.session_state.tw_data = update_portfolio_data(st.session_state.tw_data, "台股", quotes).to_dict('records')
                 if save_data_to_cloud(st.session_state.target_sheet):
                     st.rerun()
+            qs = get_quote_cache().stats()
+            st.caption(f"報價快取：{qs['entries']} 檔 · 命中 {qs['hits']} · 過期 {qs['stale_hits']} · 未命中 {qs['misses']} · 命中率 {qs['hit_rate']:.0%}")
+            daemon = get_price_daemon()
+            if PREFETCH_ENABLED and daemon.last_run:
+                st.caption(f"背景預抓：{get_symbol_registry().active()} 個 session · 追蹤 {daemon.tracked} 檔 · "
+                           f"{time.strftime('%H:%M:%S', time.localtime(daemon.last_run))} 更新 {daemon.fetched} 檔")
+            fx_caption = " · ".join(f"{c} {r:,.4g}" for c, r in valuation["fx_table"].items() if c != BASE_CURRENCY and pd.notna(r))
+            if fx_caption: st.caption(f"匯率 (對 TWD)：{fx_caption}")
 
         with st.expander("📂 **Smart Import (匯入 Excel/CSV)**"):
             import_type = st.selectbox("匯入類型", ["🇺🇸 美股/Crypto", "🇹🇼 台股", "🏠 固定資產", "💳 負債"])
             f = st.file_uploader("檔案上傳", type=['csv','xlsx'])
+            merge_mode = st.checkbox("合併至現有資料 (不覆蓋)", value=False, help="股票依代號合併股數並加權平均成本；固定資產與負債附加在後")
+            if st.session_state.get("import_msg"): st.success(st.session_state.pop("import_msg"))
             if f and st.button("確認匯入"):
                 map_t = {"🇺🇸 美股/Crypto":"stock_us", "🇹🇼 台股":"stock_tw", "🏠 固定資產":"fixed", "💳 負債":"liab"}
                 target_k = {"stock_us":"us_data", "stock_tw":"tw_data", "fixed":"fixed_data", "liab":"liab_data"}[map_t[import_type]]
                 df_new, err = parse_file(f, map_t[import_type])
                 if df_new is not None:
+                    stats = df_new.attrs.get("import_stats", {})
+                    if merge_mode: df_new = merge_into_existing(st.session_state[target_k], df_new, map_t[import_type])
                     st.session_state[target_k] = df_new.to_dict('records')
                     save_data_to_cloud(st.session_state.target_sheet)
-                    st.success("匯入成功！")
+                    st.session_state.import_msg = (f"匯入成功！{stats.get('rows', 0):,} 列 → {stats.get('records', 0):,} 筆 · "
+                                                   f"{stats.get('seconds', 0):.2f} 秒 ({stats.get('rows_per_sec', 0):,.0f} rows/s)")
                     st.rerun()
                 else: st.error(err)
 
-        def show_editor(title, key, cols, rate=1.0, is_liability=False):
+        def summary_totals():
+            v = model.summary()
+            return (v["net_worth"], v["total_assets"], v["total_liab"], v["total_monthly"], tuple(v["category_totals"].items()))
+
+        def apply_editor_changes(key, editor_key):
+            # data_editor 的 on_change：rerun 之前把逐列變動套用到模型，其他表不動
+            # 總覽有變 (或刪除了列) 時只 rerun 卡片與這張表的 fragment；沒變則照常只 rerun 這張表
+            entry = model.table(key, st.session_state[key])
+            # 變動是相對於這一代表格；表格被整份替換 (匯入、更新股價、刪除) 後 key 跟著換，舊的變動不會再套用
+            if privacy_mode or editor_key != f"e_{key}_{entry['gen']}": return
+            edited_rows = dict((st.session_state.get(editor_key) or {}).get("edited_rows") or {})
+            deleted = [int(p) for p, cells in edited_rows.items() if cells.get("❌")]
+            before = summary_totals()
+            changed = model.apply_edits(key, edited_rows)
+            if deleted:
+                st.session_state[key] = entry["df"].drop(entry["df"].index[deleted]).reset_index(drop=True)
+                st.session_state[f"deleted_{key}"] = True  # callback 內不能畫元素，提示留給表格 fragment
+            if (changed or deleted) and auto_sync: queue_cloud_sync(st.session_state.target_sheet)
+            if (changed or deleted) and key in ("us_data", "tw_data"): register_symbols()
+            if deleted or (changed and summary_totals() != before): st.rerun(["summary_cards", f"editor_{key}"])
+
+        def show_editor(title, key, cols, is_liability=False):
+            # 每張表是具名的 fragment，編輯後可以只 rerun 自己 (與總覽卡片)
+            st.fragment(table_editor, key=f"editor_{key}")(title, key, cols, is_liability)
+
+        @metered("fragment.table_editor")
+        def table_editor(title, key, cols, is_liability):
             with st.container(border=True):
                 st.markdown(f"#### {title}")
+                keep_alive()
+                if st.session_state.pop(f"deleted_{key}", False): st.toast("已刪除項目")
                 
-                df = pd.DataFrame(st.session_state[key])
-                if df.empty: df = pd.DataFrame(columns=cols)
-                
-                for c in df.columns:
-                    if c in ["股數", "現值", "金額", "自訂價格", "參考市價", "每月扣款"]:
-                        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
-                    else:
-                        df[c] = df[c].astype(str).replace("nan", "")
-
-                total_cat_val = 0
-                vals = []
-                if "股數" in df.columns:
-                    for _, r in df.iterrows():
-                        p = float(r.get("自訂價格",0))
-                        if p<=0: p = float(r.get("參考市價",0))
-                        v = p * float(r.get("股數",0)) * rate
-                        vals.append(v)
-                    df["總價值(TWD)"] = vals
-                    total_cat_val = sum(vals)
-                    
-                    if total_cat_val > 0:
-                        df["佔比 (%)"] = df["總價值(TWD)"] / total_cat_val
-                    else:
-                        df["佔比 (%)"] = 0
-                elif "現值" in df.columns:
-                    df["總價值(TWD)"] = pd.to_numeric(df["現值"], errors='coerce').fillna(0)
-                    total_cat_val = df["總價值(TWD)"].sum()
-                    if total_cat_val > 0:
-                         df["佔比 (%)"] = df["總價值(TWD)"] / total_cat_val
-                    else:
-                        df["佔比 (%)"] = 0
-                elif "金額" in df.columns:
-                    df["總價值(TWD)"] = pd.to_numeric(df["金額"], errors='coerce').fillna(0)
-                    total_cat_val = df["總價值(TWD)"].sum()
-                    if total_cat_val > 0:
-                         df["佔比 (%)"] = df["總價值(TWD)"] / total_cat_val
-                    else:
-                        df["佔比 (%)"] = 0
+                st.session_state[key] = model.entry(key, st.session_state[key])["df"]
+                entry = model.table(key, st.session_state[key])
+                editor_key = f"e_{key}_{entry['gen']}"
+
+                total_cat_val = entry["total"]
+                df = entry["df"].copy()
+                df["總價值(TWD)"] = entry["vals"]
+                df["佔比 (%)"] = entry["vals"] / total_cat_val if total_cat_val > 0 else 0.0
 
                 df["❌"] = False
                 
@@ -626,56 +2498,70 @@ def main_app():
                         "每月扣款": st.column_config.NumberColumn(label="每月扣款", format="$%d")
                     }
                 
-                edited = st.data_editor(
+                st.data_editor(
                     df, 
                     num_rows="fixed",
-                    key=f"e_{key}", 
+                    key=editor_key, 
+                    on_change=apply_editor_changes,
+                    args=(key, editor_key),
                     column_config=cfg,
                     column_order=list(df.columns),
                     use_container_width=True
                 )
 
-                col_add, col_btn = st.columns([1, 2])
-                rows_to_add = col_add.number_input("行數", min_value=1, max_value=20, value=1, key=f"num_{key}", label_visibility="collapsed")
-                
-                if col_btn.button(f"➕ 新增 {rows_to_add} 筆", key=f"add_{key}"):
+                def append_rows(n, values=None):
                     new_row = {c: "" for c in cols}
                     if "類別" in cols: 
                         if "us" in key: new_row["類別"] = "美股"
                         elif "tw" in key: new_row["類別"] = "台股"
                         elif "fixed" in key: new_row["類別"] = "固定"
+                    new_row.update(values or {})
                     
                     current_data = st.session_state[key]
                     if isinstance(current_data, pd.DataFrame):
                         current_data = current_data.to_dict('records')
+                    current_data = list(current_data)  # 整份替換，模型下次取用時重建
                     
-                    for _ in range(rows_to_add):
+                    for _ in range(n):
                         current_data.append(new_row.copy())
                         
                     st.session_state[key] = current_data
                     st.rerun()
 
-                if not privacy_mode:
-                    if edited["❌"].any():
-                        edited = edited[~edited["❌"]]
-                        cols_to_save = [c for c in edited.columns if c not in ["總價值(TWD)", "佔比 (%)", "❌"]]
-                        st.session_state[key] = edited[cols_to_save].to_dict('records')
-                        if auto_sync: save_data_to_cloud(st.session_state.target_sheet, silent=True)
-                        st.toast("已刪除項目")
-                        st.rerun()
-                    else:
-                        cols_to_save = [c for c in edited.columns if c not in ["總價值(TWD)", "佔比 (%)", "❌"]]
-                        st.session_state[key] = edited[cols_to_save].to_dict('records')
-                        if auto_sync: save_data_to_cloud(st.session_state.target_sheet, silent=True)
+                col_add, col_btn = st.columns([1, 2])
+                rows_to_add = col_add.number_input("行數", min_value=1, max_value=20, value=1, key=f"num_{key}", label_visibility="collapsed")
+                
+                if col_btn.button(f"➕ 新增 {rows_to_add} 筆", key=f"add_{key}"): append_rows(rows_to_add)
+
+                # 股票表可直接從代號總表搜尋加入：代號與名稱都已知，更新股價時不必再試後綴或查名稱
+                if key in ("us_data", "tw_data") and not privacy_mode:
+                    master = get_symbol_master()
+                    if master.size:
+                        markets = ("TWSE", "TPEX") if key == "tw_data" else ("US", "CRYPTO")
+                        q = st.text_input("搜尋代號", key=f"q_{key}", label_visibility="collapsed",
+                                          placeholder="🔍 搜尋代號或名稱 (例如 2330、台積、AAPL、Bitcoin)")
+                        hits = master.search(q, markets)
+                        if hits:
+                            c_pick, c_go = st.columns([2, 1])
+                            pick = c_pick.selectbox("搜尋結果", hits, format_func=lambda h: f"{h[0]}  {h[1]}", key=f"pick_{key}",
+                                                    label_visibility="collapsed")
+                            if c_go.button("➕ 加入", key=f"addsym_{key}"): append_rows(1, {"代號": pick[0], "名稱": pick[1]})
+                        elif q.strip(): st.caption("代號總表中找不到，仍可直接在表格輸入代號")
+                    else: st.caption("尚未建立代號總表：執行 python app.py symbols refresh 後即可搜尋代號")
+
 
         c1, c2 = st.columns(2)
-        with c1: show_editor("🇺🇸 美股/虛擬貨幣 (US Stocks & Crypto)", "us_data", ["代號","名稱","股數","類別","自訂價格","參考市價"], EXCHANGE_RATE)
-        with c2: show_editor("🇹🇼 台股 (TW Stocks)", "tw_data", ["代號","名稱","股數","類別","自訂價格","參考市價"], 1.0)
+        with c1: show_editor("🇺🇸 美股/虛擬貨幣 (US Stocks & Crypto)", "us_data", STOCK_COLS)
+        with c2: show_editor("🇹🇼 台股 (TW Stocks)", "tw_data", STOCK_COLS)
         c3, c4 = st.columns(2)
-        with c3: show_editor("🏠 固定資產", "fixed_data", ["資產項目","現值","類別"])
-        with c4: show_editor("💳 負債", "liab_data", ["負債項目","金額","每月扣款"], is_liability=True)
+        with c3: show_editor("🏠 固定資產", "fixed_data", FIXED_COLS)
+        with c4: show_editor("💳 負債", "liab_data", LIAB_COLS, is_liability=True)
 
-    with tab_fire:
+    @st.fragment
+    @metered("fragment.fire")
+    @timed("stage.fire")
+    def fire_panel():
+        keep_alive()
         c_f1, c_f2 = st.columns([1, 2])
         with c_f1:
             st.subheader("參數設定")
@@ -692,6 +2578,12 @@ def main_app():
             my_expense = st.number_input("目標年支出", value=float(st.session_state.saved_expense), step=10000.0)
             my_age = st.number_input("目前年齡", value=int(st.session_state.saved_age))
             my_savings = st.number_input("年投入投資金額 (Annual Investment)", value=float(st.session_state.saved_savings), step=10000.0, help="此金額將每年加入本金，並以複利計算成長")
+
+            mc_mode = st.toggle("🎲 蒙地卡羅模擬 (Monte Carlo)", value=False, help="隨機模擬報酬率與通膨，顯示 P10/P50/P90 區間與達標機率")
+            if mc_mode:
+                my_return_vol = st.slider("報酬率波動度 (%)", 0.0, 40.0, 15.0, 0.5)
+                my_inflation_vol = st.slider("通膨波動度 (%)", 0.0, 5.0, 1.0, 0.1)
+                my_paths = st.select_slider("模擬路徑數", options=MC_PATH_OPTIONS, value=20_000)
             
             if (my_return != st.session_state.saved_return or 
                 my_expense != st.session_state.saved_expense or 
@@ -704,26 +2596,66 @@ def main_app():
                 st.session_state.saved_age = my_age
                 st.session_state.saved_savings = my_savings
                 st.session_state.saved_inflation = my_inflation
-                if auto_sync: save_data_to_cloud(st.session_state.target_sheet, silent=True)
+                if auto_sync: queue_cloud_sync(st.session_state.target_sheet)
                 
         with c_f2:
             st.subheader("資產累積預測 (複利成長)")
             # 【關鍵修正】傳入計算後的流動資產與總負債
             # 流動資產 = 總資產(含房) - 房產價值
             # 這樣計算複利時，才不會把房產和負債也拿去算 15% 報酬率
-            liquid_assets = total_assets - df_fixed["現值"].astype(float).sum() if not df_fixed.empty else total_assets
-            house_value = df_fixed["現值"].astype(float).sum() if not df_fixed.empty else 0
+            house_value = valuation["house_value"]
+            liquid_assets = total_assets - house_value
             
-            ages, wealth_c, fire_c, custom_c = calculate_fire_curves_advanced(
-                my_age, liquid_assets, house_value, total_liab, my_savings, my_return, 3.0, my_inflation, my_expense, include_house
-            )
+            # 滑桿只是在預先算好的網格上取值；不在刻度上的數值才另外計算
+            if my_age >= FIRE_END_AGE: st.info(f"ℹ️ 預測只算到 {FIRE_END_AGE} 歲，目前年齡已達上限，圖表只顯示目前的資產")
+            grid = calculate_fire_grid(my_age, liquid_assets, house_value, total_liab, my_savings, 3.0, my_expense, include_house)
+            ri = fire_grid_index(FIRE_RETURN_GRID, my_return)
+            ii = fire_grid_index(FIRE_INFLATION_GRID, my_inflation)
+            if ri is not None and ii is not None:
+                ages, wealth_c, custom_c = grid["ages"], grid["wealth"][ri], grid["targets"][ii]
+            else:
+                ages, wealth_c, fire_c, custom_c = calculate_fire_curves_advanced(
+                    my_age, liquid_assets, house_value, total_liab, my_savings, my_return, 3.0, my_inflation, my_expense, include_house
+                )
             fig = go.Figure()
-            fig.add_trace(go.Scatter(x=ages, y=wealth_c, name="預測資產 (含複利)", line=dict(color='#00F0FF', width=4)))
+            if mc_mode:
+                mc = simulate_fire_monte_carlo(
+                    my_age, liquid_assets, house_value, total_liab, my_savings, my_return, my_return_vol,
+                    3.0, my_inflation, my_inflation_vol, my_expense, include_house, my_paths
+                )
+                fig.add_trace(go.Scatter(x=mc["ages"], y=mc["p90"], name="P90", line=dict(color='rgba(0,240,255,0.3)')))
+                fig.add_trace(go.Scatter(x=mc["ages"], y=mc["p10"], name="P10", fill='tonexty', fillcolor='rgba(0,240,255,0.12)', line=dict(color='rgba(0,240,255,0.3)')))
+                fig.add_trace(go.Scatter(x=mc["ages"], y=mc["p50"], name="P50 (中位數)", line=dict(color='#00F0FF', width=4)))
+            else:
+                fig.add_trace(go.Scatter(x=ages, y=wealth_c, name="預測資產 (含複利)", line=dict(color='#00F0FF', width=4)))
             fig.add_trace(go.Scatter(x=ages, y=custom_c, name="FIRE 目標", line=dict(color='#FFD166', dash='dot')))
             fig.update_layout(template="plotly_dark", height=500, xaxis_title="年齡", yaxis_title="資產 (TWD)")
             st.plotly_chart(fig, use_container_width=True)
 
-    with tab_vis:
+            if mc_mode:
+                st.markdown(f"**達標機率** ({mc['n_paths']:,} 條路徑)")
+                probs = {**mc["level_probs"], "自訂目標": mc["custom_prob"]}
+                milestones = [a for a in mc["ages"] if a % 5 == 0 or a == mc["ages"][-1]]
+                df_prob = pd.DataFrame({k: [v[mc["ages"].index(a)] * 100 for a in milestones] for k, v in probs.items()},
+                                       index=[f"{a} 歲" for a in milestones])
+                st.dataframe(df_prob.style.format("{:.0f}%"), use_container_width=True)
+
+            with st.expander("🗺️ 敏感度熱圖：達成 FIRE 所需年數"):
+                fig_hm = go.Figure(go.Heatmap(
+                    z=grid["years_to_fire"], x=FIRE_RETURN_GRID, y=FIRE_INFLATION_GRID,
+                    colorscale="Viridis_r", colorbar=dict(title="年"),
+                    hovertemplate="報酬率 %{x}%<br>通膨 %{y}%<br>%{z} 年<extra></extra>"
+                ))
+                fig_hm.add_trace(go.Scatter(x=[my_return], y=[my_inflation], mode="markers", name="目前設定",
+                                            marker=dict(color="#FF4B4B", size=12, symbol="x")))
+                fig_hm.update_layout(template="plotly_dark", height=450, xaxis_title="年化報酬率 (%)", yaxis_title="通貨膨脹率 (%)")
+                st.plotly_chart(fig_hm, use_container_width=True)
+
+    @st.fragment
+    @metered("fragment.visuals")
+    @timed("stage.visuals")
+    def visuals_panel():
+        keep_alive()
         if not df_assets.empty:
             c_v1, c_v2 = st.columns([1, 1])
             with c_v1:
@@ -763,20 +2695,143 @@ def main_app():
                     }
                 )
 
-    with tab_hist:
-        st.subheader("資產成長紀錄 (Cloud History)")
+    @st.fragment
+    @metered("fragment.history")
+    @timed("stage.history")
+    def history_panel():
+        keep_alive()
+        st.subheader("資產成長紀錄 (Local History)")
+        store = get_timeseries_store()
+        user_key = st.session_state.target_sheet
+        c_h1, c_h2 = st.columns([3, 1])
+        with c_h1:
+            period = st.date_input("期間", value=(date.today() - timedelta(days=365), date.today()), max_value=date.today())
+        start, end = (period[0], period[-1]) if isinstance(period, (list, tuple)) and period else (date.today() - timedelta(days=365), date.today())
+        with c_h2:
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.button("⬇️ 回補歷史股價", help="從 yfinance 批次下載期間內的收盤價 (已有的日期不重抓)"):
+                bar = st.progress(0, text="回補股價...")
+                n = store.backfill(store.user_symbols(user_key), start, progress=lambda f, t: bar.progress(f, text=t))
+                bar.empty()
+                st.toast(f"已寫入 {n:,} 筆收盤價")
+        # 雲端 History 每個 session 匯入一次：本機重建不出來的日期 (第一次快照之前等) 以它補上
+        if not st.session_state.get("history_imported"):
+            try: store.import_history(user_key, get_storage().load_history(user_key))
+            except Exception as e: st.caption(f"⚠️ 無法讀取雲端 History：{e}")
+            st.session_state.history_imported = True
+        # 每個 session 每天自動補一次持倉代號從第一次快照以來缺少的收盤
+        if st.session_state.get("ts_extended_date") != str(date.today()):
+            first = store.first_snapshot(user_key)
+            if first: store.backfill(store.user_symbols(user_key), first)
+            st.session_state.ts_extended_date = str(date.today())
+
+        df_hist = store.net_worth_series(user_key, start, end)
+        if not df_hist.empty:
+            fig = px.line(df_hist, x='Date', y='Net_Worth', title="淨資產趨勢")
+            fig.update_layout(template="plotly_dark")
+            st.plotly_chart(fig, use_container_width=True)
+        else: st.info("期間內尚無紀錄：開啟儀表板後會自動記錄今日持倉，按「回補歷史股價」可重建快照以來的淨值。")
+
+    for tab, panel in [(tab_edit, editor_panel), (tab_fire, fire_panel), (tab_vis, visuals_panel), (tab_hist, history_panel)]:
+        if tab.open:
+            with tab: panel()
+
+# --- 夜間批次 (python app.py nightly，不經 streamlit) ---
+NIGHTLY_WORKERS = int(os.environ.get("NEXUS_NIGHTLY_WORKERS", 8))  # 同時讀寫幾位使用者的資料；請求仍經過排程器依配額限流
+
+def nightly_tables(grids):
+    # 後端讀回的工作表 -> 估值用的四張表 (同 load_data_from_cloud)
+    return {key: grid_to_frame(grids.get(title), SHEET_SCHEMA[title]) for title, key in SHEET_TABLES.items()}
+
+def run_nightly(workers=NIGHTLY_WORKERS, dry_run=False, log=print):
+    # 替 Users 中的每份資料補上今天的 History 與本機快照，不必有人登入儀表板：
+    # 平行讀回各份資料 -> 所有人的代號合併成一次 fetch_quotes_batch -> 平行估值並寫入
+    # 每檔代號只下載一次，耗時與 (不重複代號數 + 使用者數) 成正比；回傳 {資料名稱: (是否成功, 說明)}
+    started, day = time.perf_counter(), str(date.today())
+    storage = get_storage()
+    targets = [t for t in dict.fromkeys(str(u.get("Target_Sheet", "")).strip() for u in storage.load_users()) if t]
+
+    def load(target):
+        try: return storage.load_tables(target)
+        except Exception as e: return e
+    with ThreadPoolExecutor(max_workers=workers) as pool: loaded = dict(zip(targets, pool.map(load, targets)))
+    tables = {t: nightly_tables(r["grids"]) for t, r in loaded.items() if not isinstance(r, Exception)}
+
+    us_syms = [s for t in tables.values() for s in portfolio_symbols(t["us_data"])[0]]
+    tw_syms = [s for t in tables.values() for s in portfolio_symbols(t["tw_data"])[0]]
+    quotes = fetch_quotes_batch(us_syms + tw_syms)
+    # 匯率也先抓好，各執行緒估值時直接命中快取
+    get_fx_rates().rates(sorted(set(symbol_currencies(us_syms, VALUATION_SPECS["us_data"][1])) |
+                                set(symbol_currencies(tw_syms, VALUATION_SPECS["tw_data"][1])) | {BASE_CURRENCY}))
+    if quotes and not dry_run:
+        try: get_timeseries_store().upsert_prices(pd.DataFrame([{sym: price for price, sym, _ in quotes.values()}], index=[day]))
+        except Exception: pass
+
+    def record(target):
+        if isinstance(loaded[target], StorageNotFound): return False, "找不到資料，請確認存在並已分享給服務帳號"
+        if target not in tables: return False, f"讀取失敗：{loaded[target]}"
         try:
-            sh = init_user_sheet(st.session_state.target_sheet)
-            data = sh.worksheet("History").get_all_records()
-            if data:
-                df_hist = pd.DataFrame(data)
-                fig = px.line(df_hist, x='Date', y='Net_Worth', title="淨資產趨勢", markers=True)
-                fig.update_layout(template="plotly_dark")
-                st.plotly_chart(fig, use_container_width=True)
-            else: st.info("尚無歷史紀錄，明日將自動生成第一筆。")
-        except: st.warning("讀取歷史紀錄時發生錯誤")
+            t = tables[target]
+            us = update_portfolio_data(t["us_data"], "美股", quotes)
+            tw = update_portfolio_data(t["tw_data"], "台股", quotes)
+            v = compute_valuation(us, tw, t["fixed_data"], t["liab_data"])
+            msg = f"淨資產 {v['net_worth']:,.0f}" + (f" (缺 {', '.join(v['missing_fx'])} 匯率，未計入)" if v["missing_fx"] else "")
+            if dry_run: return True, f"{msg} (試算，未寫入)"
+            get_timeseries_store().record_snapshot(target, day, valuation_holdings(v), v["house_value"], v["total_liab"], v["total_monthly"])
+            if day in loaded[target]["history_dates"]: return True, f"{msg} · History 今天已有紀錄"
+            storage.append_history(target, [day, v["net_worth"], v["total_assets"], v["total_liab"], v["total_monthly"]])
+            return True, f"{msg} · 已寫入 History"
+        except Exception as e: return False, f"失敗：{e}"
+    with ThreadPoolExecutor(max_workers=workers) as pool: results = dict(zip(targets, pool.map(record, targets)))
+
+    for target, (ok, msg) in results.items(): log(f"{'✓' if ok else '✗'} {target}: {msg}")
+    failed = sum(not ok for ok, _ in results.values())
+    log(f"{day} · 資料 {len(targets)} 份 · 代號 {len(set(us_syms + tw_syms))} 檔 (報價 {len(quotes)} 檔) · "
+        f"成功 {len(targets) - failed} · 失敗 {failed} · {time.perf_counter() - started:.1f} 秒")
+    return results
+
+def run_cli(argv):
+    # 不經 streamlit 直接執行 (python app.py ...)：夜間批次、本機 SQLite 的帳號管理、代號總表的重建與查詢
+    if argv[:1] == ["nightly"]:
+        import argparse  # 只有命令列模式才需要
+        parser = argparse.ArgumentParser(prog="python app.py nightly", description="替所有使用者更新股價並補上今天的 History")
+        parser.add_argument("--workers", type=int, default=NIGHTLY_WORKERS, help="同時處理的使用者數")
+        parser.add_argument("--dry-run", action="store_true", help="只試算淨資產，不寫入 History 與本機快照")
+        args = parser.parse_args(argv[1:])
+        # 命令列下 st.error / st.stop 不會中斷執行，憑證缺漏時 get_google_client 只會回傳 None，要先擋下
+        if STORAGE_BACKEND == "sheets" and get_google_client() is None:
+            print("找不到可用的 Google 服務帳號憑證：請在 .streamlit/secrets.toml 設定 [gcp_service_account]，"
+                  "或以 NEXUS_STORAGE=sqlite 改用本機儲存")
+            return 1
+        results = run_nightly(args.workers, args.dry_run)
+        return 0 if all(ok for ok, _ in results.values()) else 1
+    if argv[:2] == ["symbols", "refresh"]:
+        master = get_symbol_master()
+        report = master.refresh()
+        for market, (n, err) in report.items():
+            print(f"{market:<7}{n:>7,} 筆" + (f"  下載失敗，沿用舊資料：{err}" if err else ""))
+        print(f"已寫入 {master.path}：共 {master.size:,} 筆")
+        return 1 if all(err for m, (n, err) in report.items() if m != "CRYPTO") else 0
+    if len(argv) == 3 and argv[:2] == ["symbols", "search"]:
+        for code, name, market in get_symbol_master().search(argv[2]): print(f"{code:<10}{market:<8}{name}")
+        return 0
+    if len(argv) == 4 and argv[0] == "adduser":
+        storage = get_storage()
+        if not isinstance(storage, SqliteBackend):
+            print("adduser 只支援本機儲存 (NEXUS_STORAGE=sqlite)；Google Sheets 請直接編輯 Users 工作表")
+            return 1
+        storage.upsert_user(*argv[1:])
+        print(f"已新增 / 更新使用者：{argv[1]}")
+        return 0
+    print("用法：python app.py nightly [--workers 8] [--dry-run]\n"
+          "      NEXUS_STORAGE=sqlite python app.py adduser <帳號> <密碼> <資料名稱>\n"
+          "      python app.py symbols refresh | symbols search <代號或名稱>")
+    return 2
 
 if __name__ == "__main__":
+    if not runtime.exists(): sys.exit(run_cli(sys.argv[1:]))
     if "logged_in" not in st.session_state: st.session_state.logged_in = False
-    if st.session_state.logged_in: main_app()
-    else: login_page()
+    instrument_external_calls(get_perf_metrics())
+    with get_perf_metrics().rerun(st.session_state):
+        if st.session_state.logged_in: main_app()
+        else: login_page()
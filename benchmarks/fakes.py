@@ -0,0 +1,185 @@
+# 離線基準測試用的 yfinance / gspread 替身：全部在記憶體中執行，可設定每次呼叫的延遲並統計呼叫次數
+import re
+import time
+import zlib
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+
+class CallLog:
+    # 依方法名稱累計呼叫次數；latency 為每次呼叫固定等待的秒數 (模擬網路往返)
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def hit(self, name):
+        with self.lock: self.counts[name] += 1
+        if self.latency: time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock: self.counts.clear()
+
+    def snapshot(self):
+        with self.lock: return dict(self.counts)
+
+
+def fake_price(symbol):
+    # 以代號雜湊產生固定價格，每次執行結果相同
+    return round(10 + zlib.crc32(symbol.encode()) % 99000 / 100, 2)
+
+
+FX_PRICES = {"USDTWD=X": 32.1, "JPYTWD=X": 0.21, "HKDTWD=X": 4.1, "EURTWD=X": 34.8, "GBPTWD=X": 40.6}
+
+
+class FakeYFinance:
+    # 取代 app.yf：純數字代號只有加上 .TW / .TWO 才有報價 (模擬台股需要試後綴)，其餘代號一律有報價
+    def __init__(self, latency=0.0, history_days=5):
+        self.log = CallLog(latency)
+        self.history_days = history_days
+
+    def has_quote(self, symbol):
+        base = symbol.split(".")[0]
+        return not (base.isdigit() and "." not in symbol)
+
+    def quote(self, symbol):
+        return FX_PRICES.get(symbol, fake_price(symbol))
+
+    def download(self, tickers, start=None, end=None, period=None, **kwargs):
+        self.log.hit("download")
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        idx = pd.date_range(end=pd.Timestamp.today().normalize(), periods=self.history_days, freq="D")
+        cols = pd.MultiIndex.from_product([["Close", "Open"], tickers], names=["Price", "Ticker"])
+        values = np.array([self.quote(t) if self.has_quote(t) else np.nan for t in tickers], dtype=float)
+        block = np.tile(values, (len(idx), 1))
+        return pd.DataFrame(np.hstack([block, block]), index=idx, columns=cols)
+
+    def Ticker(self, symbol):
+        return FakeTicker(self, symbol)
+
+
+class FakeTicker:
+    def __init__(self, yf, symbol): self.yf, self.symbol = yf, symbol
+
+    def history(self, period="1d", **kwargs):
+        self.yf.log.hit("Ticker.history")
+        if not self.yf.has_quote(self.symbol): return pd.DataFrame()
+        return pd.DataFrame({"Close": [self.yf.quote(self.symbol)]})
+
+    @property
+    def info(self):
+        self.yf.log.hit("Ticker.info")
+        return {"shortName": f"{self.symbol} Corp"}
+
+
+def col_index(letters):
+    n = 0
+    for ch in letters: n = n * 26 + ord(ch) - 64
+    return n
+
+
+def parse_a1(rng):
+    # "'Title'!A1:C9" -> (Title, 起始列, 起始欄, 結束列, 結束欄)；省略的邊界為 None
+    m = re.match(r"^'?([^'!]+)'?(?:!([A-Z]+)?(\d+)?(?::([A-Z]+)?(\d+)?)?)?$", rng)
+    title, c1, r1, c2, r2 = m.groups()
+    return (title, int(r1) if r1 else None, col_index(c1) if c1 else None,
+            int(r2) if r2 else None, col_index(c2) if c2 else None)
+
+
+class FakeWorksheet:
+    def __init__(self, sh, title): self.sh, self.title = sh, title
+
+    @property
+    def rows(self): return self.sh.data[self.title]
+
+    def get_all_values(self):
+        self.sh.log.hit("get_all_values")
+        return [list(r) for r in self.rows]
+
+    def get_all_records(self):
+        self.sh.log.hit("get_all_records")
+        header, *rows = self.rows or [[]]
+        return [dict(zip(header, r)) for r in rows]
+
+    def col_values(self, col):
+        self.sh.log.hit("col_values")
+        return [r[col - 1] if len(r) >= col else "" for r in self.rows]
+
+    def append_row(self, row, **kwargs):
+        self.sh.log.hit("append_row")
+        self.rows.append(list(row))
+
+    def update(self, values, range_name=None, **kwargs):
+        self.sh.log.hit("update")
+        self.rows[:] = [list(r) for r in values]
+
+    def clear(self):
+        self.sh.log.hit("clear")
+        self.rows.clear()
+
+
+class FakeSpreadsheet:
+    # data: {工作表名稱: 二維陣列 (含標題列)}
+    def __init__(self, title, data, log):
+        self.title, self.id = title, f"fake-{title}"
+        self.data, self.log = data, log
+
+    def worksheets(self):
+        self.log.hit("worksheets")
+        return [FakeWorksheet(self, t) for t in self.data]
+
+    def worksheet(self, title):
+        self.log.hit("worksheet")
+        if title not in self.data: raise KeyError(title)
+        return FakeWorksheet(self, title)
+
+    def add_worksheet(self, title, rows=0, cols=0):
+        self.log.hit("add_worksheet")
+        self.data[title] = []
+        return FakeWorksheet(self, title)
+
+    def values_batch_get(self, ranges, params=None):
+        self.log.hit("values_batch_get")
+        out = []
+        for rng in ranges:
+            title, r1, c1, r2, c2 = parse_a1(rng)
+            rows = self.data.get(title, [])[(r1 or 1) - 1:r2]
+            out.append({"range": rng, "values": [r[(c1 or 1) - 1:c2] for r in rows]})
+        return {"valueRanges": out}
+
+    def values_batch_update(self, body):
+        self.log.hit("values_batch_update")
+        for item in body["data"]:
+            title, r1, c1, _, _ = parse_a1(item["range"])
+            rows = self.data.setdefault(title, [])
+            for i, values in enumerate(item["values"]):
+                r = (r1 or 1) - 1 + i
+                while len(rows) <= r: rows.append([])
+                row, c = rows[r], (c1 or 1) - 1
+                if len(row) < c + len(values): row.extend([""] * (c + len(values) - len(row)))
+                row[c:c + len(values)] = list(values)
+        return {}
+
+    def values_batch_clear(self, body=None, **kwargs):
+        self.log.hit("values_batch_clear")
+        for rng in (body or {}).get("ranges", []):
+            self.data.get(parse_a1(rng)[0], []).clear()
+        return {}
+
+
+class FakeClient:
+    # 取代 gspread.Client：spreadsheets 為 {名稱: {工作表: 二維陣列}}
+    def __init__(self, spreadsheets=None, latency=0.0):
+        self.log = CallLog(latency)
+        self.spreadsheets = spreadsheets if spreadsheets is not None else {}
+
+    def open(self, title):
+        self.log.hit("open")
+        return FakeSpreadsheet(title, self.spreadsheets[title], self.log)
+
+    def open_by_key(self, key):
+        self.log.hit("open_by_key")
+        return FakeSpreadsheet(key, self.spreadsheets[key], self.log)
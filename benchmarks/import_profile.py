@@ -0,0 +1,84 @@
+# 冷啟動匯入剖析：在新的 Python process 以 -X importtime 匯入 app，量測到可以顯示登入頁之前的匯入耗時
+# 並檢查延遲載入的套件 (yfinance、plotly.express、gspread、google.oauth2) 沒有在匯入時就被載入
+# 用法：python benchmarks/import_profile.py [--repeat 3] [--budget 2.5] [--top 15] [--out import.json]
+# 超過 --budget 秒或延遲載入的套件被提前載入時結束碼為 1，可放進 CI
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只有登入後才會用到的套件；匯入 app 時不應出現在 sys.modules
+# (plotly.graph_objects 會被 streamlit 自己載入，不列入檢查)
+LAZY_MODULES = ["yfinance", "plotly.express", "gspread", "google.oauth2.service_account"]
+
+PROBE = """
+import sys, time, json
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import app
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def parse_importtime(stderr):
+    # -X importtime 每行：import time: self [us] | cumulative | 模組 (縮排表示巢狀)；只取 app 直接匯入的模組
+    top = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"): continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit(): continue
+        name = parts[2]
+        if len(name) - len(name.lstrip()) != 3: continue
+        top[name.strip()] = int(parts[1]) / 1e6
+    return top
+
+
+def probe():
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE.format(root=ROOT, lazy=LAZY_MODULES)],
+                          cwd=ROOT, capture_output=True, text=True, env=env)
+    if proc.returncode != 0: raise RuntimeError(proc.stderr[-2000:])
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["modules"] = parse_importtime(proc.stderr)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NEXUS 冷啟動匯入剖析")
+    parser.add_argument("--repeat", type=int, default=3, help="啟動幾個新 process 量測，取最快的一次")
+    parser.add_argument("--budget", type=float, default=None, help="匯入 app 的秒數上限；超過時結束碼為 1")
+    parser.add_argument("--top", type=int, default=15, help="列出 app 直接匯入的模組中最慢的幾個")
+    parser.add_argument("--out", help="結果輸出的 JSON 檔；未指定時印到 stdout")
+    args = parser.parse_args(argv)
+
+    runs = [probe() for _ in range(args.repeat)]
+    best = min(runs, key=lambda r: r["seconds"])
+    loaded = sorted(set().union(*(r["loaded"] for r in runs)))
+    slowest = sorted(best["modules"].items(), key=lambda kv: kv[1], reverse=True)[:args.top]
+    failures = [f"延遲載入的套件在匯入時被載入：{', '.join(loaded)}"] if loaded else []
+    if args.budget is not None and best["seconds"] > args.budget:
+        failures.append(f"匯入 app 耗時 {best['seconds']:.2f} 秒，超過上限 {args.budget:.2f} 秒")
+
+    report = {
+        "meta": {"python": platform.python_version(), "repeat": args.repeat, "budget": args.budget},
+        "import_seconds": [round(r["seconds"], 4) for r in runs],
+        "best_seconds": round(best["seconds"], 4),
+        "eager_lazy_modules": loaded,
+        "slowest_modules": [{"module": m, "seconds": round(s, 4)} for m, s in slowest],
+        "failures": failures,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fp: fp.write(text + "\n")
+    else: print(text)
+    for msg in failures: print(msg, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+# 離線基準測試：以 benchmarks/fakes.py 取代 yfinance 與 Google Sheets，量測主要路徑在不同持倉數下的耗時與 API 呼叫數
+# 用法：python benchmarks/run_benchmarks.py [--sizes 10 1000 10000] [--repeat 3] [--yf-latency 0] [--sheets-latency 0]
+#              [--storage sheets|sqlite] [--real-quotas] [--out bench.json]
+import os
+import io
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+import streamlit.logger
+
+import app
+from fakes import FakeYFinance, FakeClient
+
+# 沒有 streamlit run 時每次讀寫 session_state 都會輸出 bare mode 警告；匯入 app 時會讀設定檔重設層級，所以在匯入後才調整
+streamlit.logger.set_log_level(logging.ERROR)
+
+SHEET_NAME = "bench_sheet"
+NIGHTLY_USERS = 20
+
+
+def holdings(n, seed=0):
+    # n 檔持倉：一半美股 (英數代號)、一半台股 (純數字，需要試 .TW 後綴)；約一成沒有名稱
+    rng = np.random.default_rng(seed)
+    n_us = n // 2
+    def table(codes, cat):
+        named = rng.random(len(codes)) > 0.1
+        return [[c, f"{c} Corp" if ok else "", float(s), cat, 0.0, 0.0]
+                for c, ok, s in zip(codes, named, rng.integers(1, 1000, len(codes)))]
+    us = table([f"U{i:05d}" for i in range(n_us)], "美股")
+    tw = table([str(1000 + i) for i in range(n - n_us)], "台股")
+    return us, tw
+
+
+def sheet_data(n):
+    us, tw = holdings(n)
+    return {
+        "US_Stocks": [app.SHEET_SCHEMA["US_Stocks"]] + us,
+        "TW_Stocks": [app.SHEET_SCHEMA["TW_Stocks"]] + tw,
+        "Fixed_Assets": [app.SHEET_SCHEMA["Fixed_Assets"], ["房子", 12000000, "房產"], ["現金", 800000, "現金"]],
+        "Liabilities": [app.SHEET_SCHEMA["Liabilities"], ["房貸", 6000000, 32000]],
+        "Settings": [["Key", "Value"], ["expense", 850000], ["age", 30], ["savings", 325000], ["return_rate", 8.0], ["inflation_rate", 2.5]],
+        "History": [app.SHEET_SCHEMA["History"], ["2026-01-01", 1, 2, 1, 0]],
+    }
+
+
+def import_csv(n):
+    us, _ = holdings(n)
+    buf = io.BytesIO(pd.DataFrame([r[:3] for r in us] * 2, columns=["symbol", "name", "shares"]).to_csv(index=False).encode("utf-8"))
+    buf.name = "holdings.csv"
+    return buf
+
+
+def reset_caches():
+    # 每次量測前清空跨 session 快取，避免前一個量測的結果被沿用
+    for fn in (app.get_resolution_cache, app.get_quote_cache, app.get_fx_rates, app.get_sync_queues, app.get_storage, app.get_schedulers,
+               app.get_symbol_master):
+        fn.clear()
+    for fn in (app.calculate_fire_curves_advanced,):
+        fn.clear()
+    st.session_state.clear()
+
+
+def measure(fn, repeat, setup=None, logs=()):
+    # 回傳 (各次耗時, 第一次執行的呼叫次數)
+    times, calls = [], None
+    for i in range(repeat):
+        if setup: setup()
+        for log in logs: log.reset()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+        if calls is None:
+            calls = {}
+            for log in logs: calls.update(log.snapshot())
+    return times, calls
+
+
+def run_size(n, repeat, yf, client):
+    results = []
+    logs = (yf.log, client.log)
+
+    def record(name, times, calls):
+        results.append({"name": name, "size": n, "repeat": len(times), "seconds_min": min(times),
+                        "seconds_median": statistics.median(times), "calls": calls})
+
+    def fresh_sheet():
+        reset_caches()
+        client.spreadsheets[SHEET_NAME] = sheet_data(n)
+        if app.STORAGE_BACKEND == "sqlite":
+            data = sheet_data(n)
+            app.get_storage().write_tables(SHEET_NAME, {t: data[t] for t in app.SQLITE_TABLES}, {})
+
+    # 載入：一次 batchGet 讀回所有工作表
+    record("load_data_from_cloud", *measure(lambda: app.load_data_from_cloud(SHEET_NAME), repeat, fresh_sheet, logs))
+
+    # 存檔：沒有變動 / 1% 的列有變動 / 沒有基準 (整張重寫)
+    def loaded():
+        fresh_sheet()
+        app.load_data_from_cloud(SHEET_NAME)
+    record("save_data_to_cloud[unchanged]", *measure(lambda: app.save_data_to_cloud(SHEET_NAME, silent=True), repeat, loaded, logs))
+
+    def edited():
+        loaded()
+        df = pd.DataFrame(st.session_state.us_data)
+        step = max(1, len(df) // max(1, len(df) // 100))
+        df.loc[::step, "股數"] = pd.to_numeric(df.loc[::step, "股數"]) + 1
+        st.session_state.us_data = df
+    record("save_data_to_cloud[1pct_changed]", *measure(lambda: app.save_data_to_cloud(SHEET_NAME, silent=True), repeat, edited, logs))
+
+    def no_baseline():
+        loaded()
+        app.get_sync_queue(SHEET_NAME).reset({})
+    record("save_data_to_cloud[full_rewrite]", *measure(lambda: app.save_data_to_cloud(SHEET_NAME, silent=True), repeat, no_baseline, logs))
+
+    # 更新股價：冷快取 (需要解析代號) 與熱快取
+    us, tw = holdings(n)
+    us_df = pd.DataFrame(us, columns=app.STOCK_COLS)
+    tw_df = pd.DataFrame(tw, columns=app.STOCK_COLS)
+    def update_prices():
+        us_syms, us_names = app.portfolio_symbols(us_df)
+        tw_syms, tw_names = app.portfolio_symbols(tw_df)
+        quotes = app.fetch_quotes_batch(us_syms + tw_syms, us_names + tw_names)
+        app.update_portfolio_data(us_df, "美股", quotes)
+        app.update_portfolio_data(tw_df, "台股", quotes)
+    record("update_prices[cold]", *measure(update_prices, repeat, reset_caches, logs))
+    reset_caches()
+    update_prices()
+    record("update_prices[warm]", *measure(update_prices, repeat, None, logs))
+
+    # 代號總表涵蓋所有持倉時的冷快取：直接下載有效代號 (台股一半為上櫃 .TWO)，不必試後綴或查名稱
+    master_path = os.path.join(app.CACHE_DIR, f"symbol_master_{n}.tsv")
+    with open(master_path, "w", encoding="utf-8") as fp:
+        fp.write("\t".join(app.SymbolMaster.COLUMNS) + "\n")
+        for i, code in enumerate(us_df["代號"].tolist() + tw_df["代號"].tolist()):
+            sym, market = (code, "US") if not code.isdigit() else (f"{code}.TWO", "TPEX") if i % 2 else (f"{code}.TW", "TWSE")
+            fp.write(f"{code}\t{sym}\t{code} Corp\t{market}\n")
+    def with_master():
+        reset_caches()
+        app.SYMBOL_MASTER_PATH = master_path
+    record("update_prices[cold+symbol_master]", *measure(update_prices, repeat, with_master, logs))
+    record("symbol_master.search", *measure(lambda: app.get_symbol_master().search("1"), repeat, None, logs))
+    app.SYMBOL_MASTER_PATH = None
+    reset_caches()
+    quotes = app.fetch_quotes_batch(us_df["代號"].tolist() + tw_df["代號"].tolist())
+    record("update_portfolio_data", *measure(lambda: app.update_portfolio_data(us_df, "美股", quotes), repeat, None, logs))
+
+    # 夜間批次：NIGHTLY_USERS 位使用者持有同一批代號，下載次數應與單一使用者的冷快取相同，不隨使用者數倍增
+    def nightly_users():
+        reset_caches()
+        users = [f"user{i:02d}" for i in range(NIGHTLY_USERS)]
+        client.spreadsheets[app.ADMIN_DB_NAME] = {"Users": [["Username", "Password", "Target_Sheet"]] + [[u, "x", f"{SHEET_NAME}_{u}"] for u in users]}
+        for u in users:
+            client.spreadsheets[f"{SHEET_NAME}_{u}"] = data = sheet_data(n)
+            if app.STORAGE_BACKEND == "sqlite":
+                app.get_storage().write_tables(f"{SHEET_NAME}_{u}", {t: data[t] for t in app.SQLITE_TABLES}, {})
+                app.get_storage().upsert_user(u, "x", f"{SHEET_NAME}_{u}")
+    record(f"run_nightly[users={NIGHTLY_USERS}]", *measure(lambda: app.run_nightly(log=lambda msg: None), repeat, nightly_users, logs))
+
+    # 匯入：n 檔持倉，每檔兩筆 (需要合併)
+    record("parse_file", *measure(lambda: app.parse_file(import_csv(n), "stock_us"), repeat, None, logs))
+
+    # 估值：main_app 每次 rerun 都會執行的 compute_valuation
+    us_priced = app.update_portfolio_data(us_df, "美股", quotes).to_dict("records")
+    tw_priced = app.update_portfolio_data(tw_df, "台股", quotes).to_dict("records")
+    fixed = [{"資產項目": "房子", "現值": 12000000, "類別": "房產"}]
+    liab = [{"負債項目": "房貸", "金額": 6000000, "每月扣款": 32000}]
+    valuate = lambda: app.compute_valuation(us_priced, tw_priced, fixed, liab)
+    record("compute_valuation", *measure(valuate, repeat, None, logs))
+
+    # 單一儲存格編輯：PortfolioModel 只重算被改到的列
+    model = app.PortfolioModel()
+    tables = {key: model.entry(key, d)["df"] for key, d in zip(app.VALUATION_SPECS, (us_priced, tw_priced, fixed, liab))}
+    model.refresh(tables)
+    edits = iter(range(10 ** 9))
+    record("portfolio_model.apply_edit", *measure(lambda: (model.apply_edits("us_data", {"0": {"股數": next(edits) + 1}}), model.summary(tables)),
+                                                  repeat, None, logs))
+
+    # FIRE 曲線：以估值結果為輸入，分別量測未命中與命中 st.cache_data
+    v = valuate()
+    args = (30, v["total_assets"] - v["house_value"], v["house_value"], v["total_liab"], 325000, 8.0, 2.0, 2.5, 850000, True)
+    record("calculate_fire_curves_advanced[cold]", *measure(lambda: app.calculate_fire_curves_advanced(*args), repeat,
+                                                              app.calculate_fire_curves_advanced.clear, logs))
+    record("calculate_fire_curves_advanced[warm]", *measure(lambda: app.calculate_fire_curves_advanced(*args), repeat, None, logs))
+    return results
+
+
+def git_revision():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NEXUS 離線基準測試")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="持倉數")
+    parser.add_argument("--repeat", type=int, default=3, help="每項量測重複次數")
+    parser.add_argument("--yf-latency", type=float, default=0.0, help="假 yfinance 每次呼叫的延遲 (秒)")
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="假 Google Sheets 每次呼叫的延遲 (秒)")
+    parser.add_argument("--storage", choices=["sheets", "sqlite"], default="sheets", help="儲存後端")
+    parser.add_argument("--real-quotas", action="store_true", help="套用 app.API_LIMITS 的每分鐘配額；預設不限流，只量測程式本身")
+    parser.add_argument("--out", help="結果輸出的 JSON 檔；未指定時印到 stdout")
+    args = parser.parse_args(argv)
+
+    if not args.real_quotas:
+        for limits in app.API_LIMITS.values(): limits.update(per_minute=1e9, burst=1e9)
+
+    yf, client = FakeYFinance(args.yf_latency), FakeClient(latency=args.sheets_latency)
+    app.yf = yf
+    app.get_google_client = lambda: client
+    # 代號快取等磁碟檔案寫到暫存目錄，不動到專案內的 .nexus_cache
+    app.CACHE_DIR = tempfile.mkdtemp(prefix="nexus_bench_")
+    app.STORAGE_BACKEND, app.SQLITE_STORAGE_PATH = args.storage, os.path.join(app.CACHE_DIR, "nexus.db")
+    app.TIMESERIES_DB = os.path.join(app.CACHE_DIR, "timeseries.db")
+
+    results = []
+    for n in args.sizes:
+        results += run_size(n, args.repeat, yf, client)
+        print(f"size {n}: done", file=sys.stderr)
+
+    report = {
+        "meta": {"revision": git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "pandas": pd.__version__, "numpy": np.__version__, "streamlit": st.__version__,
+                 "storage": args.storage, "yf_latency": args.yf_latency, "sheets_latency": args.sheets_latency, "real_quotas": args.real_quotas,
+                 "repeat": args.repeat},
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fp: fp.write(text + "\n")
+    else: print(text)
+
+
+if __name__ == "__main__":
+    main()
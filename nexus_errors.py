@@ -0,0 +1,19 @@
+# app.py 共用的例外類別：streamlit 每次 rerun 都重新執行 app.py (新的 __main__)，
+# st.cache_resource 快取的物件卻會沿用舊 rerun 定義的類別；例外放在獨立模組只載入一次，except 才比對得到
+import time
+
+
+class RateLimited(Exception):
+    # 後端已限流但沒有丟出例外 (yf.download 只把錯誤寫進 log)
+    pass
+
+
+class CircuitOpen(Exception):
+    def __init__(self, backend, retry_at):
+        self.backend, self.retry_at = backend, retry_at
+        super().__init__(f"{backend} 連續失敗，暫停呼叫 {max(0.0, retry_at - time.time()):.0f} 秒")
+
+
+class StorageNotFound(Exception):
+    # 找不到使用者清單或個人資料 (試算表)
+    pass
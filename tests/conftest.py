@@ -0,0 +1,7 @@
+# 測試直接 import 專案根目錄的 app.py 與 benchmarks/fakes.py (離線替身)
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "benchmarks")):
+    if path not in sys.path: sys.path.insert(0, path)
@@ -0,0 +1,22 @@
+# FIRE 試算：已超過模擬終點年齡時仍要回傳只有起點的曲線，而不是丟出例外
+import app
+
+
+def test_fire_grid_past_end_age():
+    grid = app.calculate_fire_grid(66, 1e6, 1e7, 5e6, 1e5, 3.0, 8e5, True)
+    assert grid["ages"] == [66]
+    assert grid["wealth"].shape == (len(app.FIRE_RETURN_GRID), 1)
+    assert grid["wealth"][0, 0] == 1e6 + 1e7 - 5e6
+    assert grid["years_to_fire"].shape == (len(app.FIRE_INFLATION_GRID), len(app.FIRE_RETURN_GRID))
+
+
+def test_fire_curves_match_grid_past_end_age():
+    ages, wealth, _, custom = app.calculate_fire_curves_advanced(66, 1e6, 1e7, 5e6, 1e5, 7.0, 3.0, 2.0, 8e5, True)
+    assert ages == [66] and len(wealth) == len(custom) == 1
+
+
+def test_monte_carlo_past_end_age():
+    mc = app.simulate_fire_monte_carlo(66, 1e6, 1e7, 5e6, 1e5, 7.0, 15.0, 3.0, 2.0, 1.0, 8e5, True, n_paths=1000)
+    assert mc["ages"] == [66]
+    assert mc["p10"] == mc["p50"] == mc["p90"] == [1e6 + 1e7 - 5e6]
+    assert all(len(p) == 1 for p in mc["level_probs"].values()) and len(mc["custom_prob"]) == 1
@@ -0,0 +1,21 @@
+# 匯入 CSV：編碼只以開頭樣本判斷，後段才出現的 Big5 文字要改用 cp950 重讀
+import io
+
+import app
+
+
+def upload(name, data):
+    f = io.BytesIO(data)
+    f.name = name
+    return f
+
+
+def test_csv_with_big5_after_ascii_sample():
+    head = "item,value\n" + "".join(f"asset{i},100\n" for i in range(app.IMPORT_SAMPLE_BYTES // 10))
+    data = head.encode("ascii") + "房子,2500000\n".encode("cp950")
+    assert len(head) > app.IMPORT_SAMPLE_BYTES
+    df, err = app.parse_file(upload("assets.csv", data), "fixed")
+    assert err is None
+    assert df["資產項目"].iloc[-1] == "房子"
+    assert df["現值"].iloc[-1] == 2500000
+    assert len(df) == app.IMPORT_SAMPLE_BYTES // 10 + 1
@@ -0,0 +1,53 @@
+# 儲存後端：快取的後端跨 rerun 丟出的例外仍要被 app 認得、帳號密碼的處理與登入一致
+import os
+import sys
+import types
+
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import app
+from conftest import ROOT
+from fakes import FakeClient, FakeSpreadsheet, FakeWorksheet
+
+
+@pytest.fixture
+def fake_sheets(monkeypatch):
+    # 以 benchmarks/fakes.py 的 FakeClient 取代 gspread 與 Google 憑證；Users 指向一份不存在的試算表
+    client = FakeClient({"nexus_data": {"Users": [["Username", "Password", "Target_Sheet"], ["eddie", "pw", "missing_sheet"]]}})
+    gspread = types.ModuleType("gspread")
+    gspread.SpreadsheetNotFound = type("SpreadsheetNotFound", (Exception,), {})
+    gspread.exceptions = types.SimpleNamespace(APIError=type("APIError", (Exception,), {}))
+    gspread.Client, gspread.Spreadsheet, gspread.Worksheet = FakeClient, FakeSpreadsheet, FakeWorksheet
+    gspread.authorize = lambda creds: client
+    monkeypatch.setitem(sys.modules, "gspread", gspread)
+    from google.oauth2 import service_account
+    monkeypatch.setattr(service_account.Credentials, "from_service_account_info", staticmethod(lambda info, scopes=None: object()))
+    monkeypatch.setenv("NEXUS_STORAGE", "sheets")
+    st.cache_resource.clear()
+    yield client
+    st.cache_resource.clear()
+
+
+def test_missing_sheet_after_rerun_shows_not_found(fake_sheets):
+    # 登入那次 rerun 建立並快取後端；之後的 rerun 重新定義 app 內的類別，找不到試算表仍要走專屬訊息並停止
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=30)
+    at.secrets["gcp_service_account"] = {"client_email": "bot@example.com", "private_key": "k"}
+    at.run()
+    at.text_input[0].input("eddie")
+    at.text_input[1].input("pw")
+    at.button[0].click()
+    at.run()
+    assert not at.exception
+    assert any("找不到個人試算表" in e.value for e in at.error)
+    assert not any("資料讀取錯誤" in e.value for e in at.error)
+
+
+def test_adduser_password_is_normalized_like_login(tmp_path):
+    # adduser 與登入都去除密碼前後空白，含空白設定的密碼仍能登入
+    storage = app.SqliteBackend(str(tmp_path / "nexus.db"))
+    storage.upsert_user("eddie", " pw ", "eddie_data")
+    users = app.UserDirectory(storage.load_users)
+    assert users.authenticate("eddie", " pw ") == "eddie_data"
+    assert users.authenticate("eddie", "pw") == "eddie_data"